@@ -8,8 +8,82 @@ Authors:
     - Benjamin Dourthe (benjamin@adonamed.com)
 """
 import re
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate, islice, takewhile
 from typing import List, Dict, Tuple, Optional
-from .tokens import estimate_tokens
+from .tokens import estimate_tokens, estimate_tokens_cached
+
+_SENT_SPLIT = re.compile(r'[.!?]+')
+_WORD_RE = re.compile(r'\b[a-zA-Z]{3,}\b')
+_QUESTION_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'\bhow (?:do|can|to) (.*?)[\?\.]',
+    r'\bwhat (?:is|are) (.*?)[\?\.]',
+    r'\bwhy (?:does|is|are) (.*?)[\?\.]',
+    r'\bexplain (.*?)[\?\.]',
+    r'\btell me about (.*?)[\?\.]',
+))
+# One pass over the union of the question prefixes; content that cannot match
+# any pattern skips the five individual searches
+_QUESTION_GATE = re.compile(
+    r'\b(?:how (?:do|can|to)|what (?:is|are)|why (?:does|is|are)|explain|tell me about) ',
+    re.IGNORECASE,
+)
+
+# Importance markers, shared by _is_important_message and _extract_key_info.
+# Plain substring checks run in C and beat tokenizing the content into a set.
+_USER_MARKERS = ('how', 'what', 'why', 'when', 'where', 'can you', 'please')
+_ASSISTANT_MARKERS = ('```', 'def ', 'class ', 'import ', 'function', 'method', 'steps:', 'example:')
+_MARKER_SCAN_CHARS = 512
+_MARKER_OVERLAP = max(map(len, _USER_MARKERS + _ASSISTANT_MARKERS)) - 1
+# List items only count at the start of a line, within the opening part of a response
+_LIST_MARKERS = ('1.', '2.', '- ', '* ')
+_LIST_LINE_MARKERS = tuple('\n' + marker for marker in _LIST_MARKERS)
+_LIST_SCAN_CHARS = 2000
+_TRUNCATE_CACHE_SIZE = 4
+
+
+def _has_list_marker(content: str) -> bool:
+    """Return True if a numbered or bulleted list item starts a line near the top."""
+    if content.startswith(_LIST_MARKERS):
+        return True
+    window = content[:_LIST_SCAN_CHARS]
+    return any(marker in window for marker in _LIST_LINE_MARKERS)
+
+
+@lru_cache(maxsize=1024)
+def _extract_topic_cached(content: str) -> str:
+    """Extract main topic from user message (cached by content)."""
+    # Look for common question patterns
+    if _QUESTION_GATE.search(content):
+        for pattern in _QUESTION_PATTERNS:
+            match = pattern.search(content)
+            if match:
+                topic = match.group(1).strip().lower()
+                if len(topic) < 50:  # Reasonable topic length
+                    return topic
+    
+    # Fallback: extract first few meaningful words
+    words = _WORD_RE.findall(content)
+    if words:
+        return ' '.join(words[:3])
+        
+    return "general topic"
+
+
+@lru_cache(maxsize=1024)
+def _extract_key_info_cached(content: str) -> str:
+    """Extract key information from assistant response (cached by content)."""
+    # Look for structured information
+    if '```' in content:
+        return "code examples"
+    elif _has_list_marker(content):
+        return "step-by-step information"
+    elif len(content) > 500:
+        return "detailed information"
+    else:
+        return "information"
 
 
 class ContextManager:
@@ -20,26 +94,68 @@ class ContextManager:
         self.max_tokens = max_tokens
         self.reserve_tokens = reserve_tokens  # Reserve for response
         self.available_tokens = max_tokens - reserve_tokens
+        self._truncate_cache: "OrderedDict[Tuple, List]" = OrderedDict()
         
     def truncate_messages(self, messages: List[Dict]) -> List[Dict]:
         """Truncate messages to fit within context window."""
         if not messages:
             return messages
             
+        # Repeat calls on the same history reuse the previous selection. Entries are
+        # stored as indices into the input so hits return the caller's own dicts;
+        # a shortened message is stored as its source index and shortened content.
+        key = self._truncate_key(messages)
+        plan = self._truncate_cache.get(key)
+        if plan is not None:
+            self._truncate_cache.move_to_end(key)
+            return [messages[p] if isinstance(p, int) else {**messages[p[0]], 'content': p[1]}
+                    for p in plan]
+            
+        result = self._truncate_uncached(messages)
+        positions = {id(m): i for i, m in enumerate(messages)}
+        plan = []
+        for r, m in enumerate(result):
+            i = positions.get(id(m))
+            if i is None:
+                # A shortened copy always sits right before the next kept message,
+                # so its source is the closest non-system message preceding that one
+                i = positions[id(result[r + 1])] - 1
+                while messages[i].get('role') == 'system':
+                    i -= 1
+                plan.append((i, m.get('content')))
+            else:
+                plan.append(i)
+        self._truncate_cache[key] = plan
+        if len(self._truncate_cache) > _TRUNCATE_CACHE_SIZE:
+            self._truncate_cache.popitem(last=False)
+        return result
+    
+    def _truncate_key(self, messages: List[Dict]) -> Tuple:
+        """Return a cache key for the history and the current limits.
+        
+        Histories only grow by appending new dicts, so the length and the
+        identity of the first and last messages tell them apart without
+        walking the list.
+        """
+        return (self.available_tokens, len(messages), id(messages[0]), id(messages[-1]))
+    
+    def _truncate_uncached(self, messages: List[Dict]) -> List[Dict]:
+        """Select the messages to keep without consulting the cache."""
         # Always keep system messages and the last user message
-        system_messages = [m for m in messages if m.get('role') == 'system']
-        other_messages = [m for m in messages if m.get('role') != 'system']
+        system_messages, other_messages = [], []
+        for m in messages:
+            (system_messages if m.get('role') == 'system' else other_messages).append(m)
         
         if not other_messages:
             return system_messages
             
         # Keep the last user message (current prompt)
-        last_message = other_messages[-1] if other_messages else None
-        conversation_messages = other_messages[:-1] if len(other_messages) > 1 else []
+        last_message = other_messages[-1]
+        history_end = len(other_messages) - 1
         
         # Calculate token usage for required messages
-        system_tokens = sum(estimate_tokens(m.get('content', '')) for m in system_messages)
-        last_message_tokens = estimate_tokens(last_message.get('content', '')) if last_message else 0
+        system_tokens = sum(self._msg_tokens(m) for m in system_messages)
+        last_message_tokens = self._msg_tokens(last_message) if last_message else 0
         
         required_tokens = system_tokens + last_message_tokens
         available_for_history = self.available_tokens - required_tokens
@@ -53,7 +169,7 @@ class ContextManager:
         
         # Select conversation history using sliding window
         selected_history = self._select_conversation_history(
-            conversation_messages, available_for_history
+            other_messages, available_for_history, end=history_end
         )
         
         # Combine all selected messages
@@ -64,76 +180,111 @@ class ContextManager:
             
         return result
     
-    def _select_conversation_history(self, messages: List[Dict], token_budget: int) -> List[Dict]:
-        """Select conversation history messages within token budget."""
-        if not messages:
+    def _select_conversation_history(self, messages: List[Dict], token_budget: int,
+                                     end: Optional[int] = None) -> List[Dict]:
+        """Select conversation history messages within token budget.
+        
+        Only messages[:end] are considered, so callers can exclude a tail
+        without slicing the list.
+        """
+        n = len(messages) if end is None else end
+        if n <= 0:
             return []
             
-        # Start from the most recent messages and work backwards
-        selected = []
-        current_tokens = 0
+        # Cumulative token totals of the most recent messages: tail[k] covers messages[n-k:n].
+        # Totals only grow, so counting stops at the first run that no longer fits the budget.
+        tail = [0]
+        tail.extend(takewhile(
+            lambda total: total <= token_budget,
+            accumulate(map(self._msg_tokens, islice(reversed(messages), len(messages) - n, None))),
+        ))
+        
+        # The longest run of recent messages that fits the budget
+        kept = len(tail) - 1
+        older = []  # messages picked past the boundary, newest first
+        current_tokens = tail[kept]
         
-        for message in reversed(messages):
+        # Walk backwards from the boundary message that did not fit
+        for i in range(n - kept - 1, -1, -1):
+            message = messages[i]
             content = message.get('content', '')
-            msg_tokens = estimate_tokens(content)
+            msg_tokens = self._msg_tokens(message)
             
             if current_tokens + msg_tokens <= token_budget:
-                selected.insert(0, message)  # Insert at beginning to maintain order
+                older.append(message)
                 current_tokens += msg_tokens
             else:
                 # Try to include a truncated version of this message if it's important
-                if self._is_important_message(message) and len(selected) < 2:
+                if self._is_important_message(message) and kept + len(older) < 2:
                     remaining_budget = token_budget - current_tokens
                     if remaining_budget > 50:  # Only if we have reasonable space
                         truncated_content = self._truncate_content(content, remaining_budget)
                         if truncated_content:
                             truncated_msg = message.copy()
                             truncated_msg['content'] = truncated_content
-                            selected.insert(0, truncated_msg)
+                            older.append(truncated_msg)
                             break
                 else:
                     break
-                    
-        return selected
+        
+        older.reverse()
+        older += messages[n - kept:n]
+        return older
+    
+    def _msg_tokens(self, message: Dict) -> int:
+        """Return the token count for a message, memoized by its content (the dict is left untouched)."""
+        return estimate_tokens_cached(message.get('content', ''))
     
     def _is_important_message(self, message: Dict) -> bool:
         """Determine if a message is important to preserve."""
-        content = message.get('content', '').lower()
         role = message.get('role', '')
+        content = message.get('content', '')
         
         # Consider user questions and assistant responses with key information
         if role == 'user':
-            # Questions and commands are usually important
-            return any(marker in content for marker in [
-                '?', 'how', 'what', 'why', 'when', 'where', 'can you', 'please'
-            ])
+            # Questions and commands are usually important; a question mark
+            # needs no case folding, so check the raw text for it first
+            if '?' in content:
+                return True
+            markers = _USER_MARKERS
         elif role == 'assistant':
             # Responses with structured information, code, or explanations
-            return any(marker in content for marker in [
-                '```', 'def ', 'class ', 'import ', 'function', 'method',
-                '1.', '2.', '- ', '* ', 'steps:', 'example:'
-            ])
+            if _has_list_marker(content):
+                return True
+            markers = _ASSISTANT_MARKERS
+        else:
+            return False
             
-        return False
+        # Most hits are near the top, so lowercase the head first and the rest only on a miss
+        head = content[:_MARKER_SCAN_CHARS].lower()
+        if any(marker in head for marker in markers):
+            return True
+        if len(content) <= _MARKER_SCAN_CHARS:
+            return False
+        # The tail overlaps the head so a marker straddling the cut is still seen
+        tail = content[_MARKER_SCAN_CHARS - _MARKER_OVERLAP:].lower()
+        return any(marker in tail for marker in markers)
     
     def _truncate_content(self, content: str, max_tokens: int) -> str:
         """Truncate content to fit within token limit while preserving meaning."""
-        if estimate_tokens(content) <= max_tokens:
+        if estimate_tokens_cached(content) <= max_tokens:
             return content
             
         # Try to truncate at sentence boundaries
-        sentences = re.split(r'[.!?]+', content)
+        sentences = _SENT_SPLIT.split(content)
         if len(sentences) > 1:
-            truncated = ""
-            for sentence in sentences:
-                test_content = truncated + sentence + "."
-                if estimate_tokens(test_content) <= max_tokens:
-                    truncated = test_content
-                else:
-                    break
+            pieces = [sentence + "." for sentence in sentences]
+            # Binary-search the per-sentence prefix sums for a candidate cut, then
+            # settle it against the estimate of the actual prefix text
+            prefix = list(accumulate(map(estimate_tokens, pieces)))
+            kept = bisect_right(prefix, max_tokens)
+            while kept > 0 and estimate_tokens("".join(pieces[:kept])) > max_tokens:
+                kept -= 1
+            while kept < len(pieces) and estimate_tokens("".join(pieces[:kept + 1])) <= max_tokens:
+                kept += 1
             
-            if truncated:
-                return truncated + "..."
+            if kept:
+                return "".join(pieces[:kept]) + "..."
         
         # Fallback: truncate by approximate character count
         # Rough estimate: 1 token ≈ 4 characters
@@ -145,47 +296,53 @@ class ContextManager:
     
     def should_summarize(self, messages: List[Dict]) -> bool:
         """Check if messages should be summarized."""
-        total_tokens = self.estimate_total_tokens(messages)
-        return total_tokens > self.max_tokens * 0.7
+        # Stop as soon as the running total crosses the threshold
+        threshold = self.max_tokens * 0.7
+        total_tokens = 0
+        for m in messages:
+            total_tokens += self._msg_tokens(m)
+            if total_tokens > threshold:
+                return True
+        return False
     
     def estimate_total_tokens(self, messages: List[Dict]) -> int:
         """Estimate total tokens for a list of messages."""
-        return sum(estimate_tokens(m.get('content', '')) for m in messages)
+        return sum(map(self._msg_tokens, messages))
     
     def summarize_context(self, messages: List[Dict]) -> str:
         """Create a summary of older messages."""
         if not messages:
             return ""
             
-        # Group messages by conversation turns (user-assistant pairs)
-        turns = []
-        current_turn = []
+        # Group messages into turns in a single pass: a turn closes on an
+        # assistant message or once it holds two messages
+        summary_points = []
+        turn_count = 0
+        pending = None
         
         for message in messages:
             role = message.get('role', '')
             if role == 'system':
                 continue  # Skip system messages for summarization
                 
-            current_turn.append(message)
-            
-            # Complete turn when we have both user and assistant messages
-            if len(current_turn) >= 2 or role == 'assistant':
-                turns.append(current_turn[:])
-                current_turn = []
-        
-        if not turns:
-            return ""
-        
-        # Summarize key points from the conversation
-        summary_points = []
-        
-        for i, turn in enumerate(turns):
-            user_msg = next((m for m in turn if m.get('role') == 'user'), None)
-            assistant_msg = next((m for m in turn if m.get('role') == 'assistant'), None)
+            if pending is None and role != 'assistant':
+                pending = message
+                continue
+                
+            # Resolve the turn's user/assistant messages from the roles seen here
+            if pending is not None and pending.get('role') == 'user':
+                user_msg = pending
+            else:
+                user_msg = message if role == 'user' else None
+            assistant_msg = message if role == 'assistant' else None
+            pending = None
+            turn_count += 1
             
             if user_msg:
                 user_content = user_msg.get('content', '')
-                if len(user_content) > 50:  # Only summarize substantial messages
+                # Only summarize substantial messages; pastes and single tokens
+                # with hardly any spaces carry no extractable topic
+                if len(user_content) > 50 and user_content.count(' ') >= 3:
                     # Extract key topics or questions
                     topic = self._extract_topic(user_content)
                     if topic:
@@ -198,50 +355,25 @@ class ContextManager:
                     key_info = self._extract_key_info(assistant_content)
                     if key_info:
                         summary_points.append(f"Assistant explained {key_info}")
+            
+            if len(summary_points) >= 5:
+                break  # Only the first five points are reported
+        
+        if not turn_count:
+            return ""
         
         if summary_points:
             return "Previous conversation summary:\n" + "\n".join(f"- {point}" for point in summary_points[:5])
         
-        return f"Previous conversation involved {len(turns)} exchanges between user and assistant."
+        return f"Previous conversation involved {turn_count} exchanges between user and assistant."
     
     def _extract_topic(self, content: str) -> str:
         """Extract main topic from user message."""
-        content_lower = content.lower()
-        
-        # Look for common question patterns
-        question_patterns = [
-            r'how (?:do|can|to) (.*?)[\?\.]',
-            r'what (?:is|are) (.*?)[\?\.]',
-            r'why (?:does|is|are) (.*?)[\?\.]',
-            r'explain (.*?)[\?\.]',
-            r'tell me about (.*?)[\?\.]'
-        ]
-        
-        for pattern in question_patterns:
-            match = re.search(pattern, content_lower)
-            if match:
-                topic = match.group(1).strip()
-                if len(topic) < 50:  # Reasonable topic length
-                    return topic
-        
-        # Fallback: extract first few meaningful words
-        words = re.findall(r'\b[a-zA-Z]{3,}\b', content)
-        if words:
-            return ' '.join(words[:3])
-            
-        return "general topic"
+        return _extract_topic_cached(content)
     
     def _extract_key_info(self, content: str) -> str:
         """Extract key information from assistant response."""
-        # Look for structured information
-        if '```' in content:
-            return "code examples"
-        elif any(marker in content for marker in ['1.', '2.', '- ', '* ']):
-            return "step-by-step information"
-        elif len(content) > 500:
-            return "detailed information"
-        else:
-            return "information"
+        return _extract_key_info_cached(content)
     
     def get_context_window_usage(self, messages: List[Dict]) -> Tuple[int, int, float]:
         """Get context window usage statistics."""
@@ -253,8 +385,10 @@ class ContextManager:
         """Update maximum token limit."""
         self.max_tokens = max(1024, max_tokens)  # Minimum 1024 tokens
         self.available_tokens = self.max_tokens - self.reserve_tokens
+        self._truncate_cache.clear()
     
     def set_reserve_tokens(self, reserve_tokens: int) -> None:
         """Update reserved tokens for response generation."""
         self.reserve_tokens = max(256, reserve_tokens)  # Minimum 256 tokens reserved
         self.available_tokens = self.max_tokens - self.reserve_tokens
+        self._truncate_cache.clear()
@@ -6,21 +6,175 @@ Provides process management and minimal output parsing for assistant messages.
 Authors:
     - Benjamin Dourthe (benjamin@adonamed.com)
 """
+import codecs
 import os
 import re
 import subprocess
 import threading
 import queue
 import time
-import select
+import selectors
+import shutil
 import gc
-import fcntl
-import io
-from typing import Callable, List, Optional, Tuple, Dict
+import types
+from collections import OrderedDict
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from typing import Callable, List, Mapping, Optional, Set, Tuple, Dict
+from . import storage
+from .context_manager import ContextManager
 from .token_tracker import get_token_tracker, TokenMetrics
+from .tokens import estimate_tokens
 from .gpu_monitor import get_gpu_monitor, GPUMemoryInfo
 
-_ASSISTANT_BLOCK_RE = re.compile(r"<\|start\|>assistant<\|channel\|>final<\|message\|>(.*?)<\|return\|>", re.DOTALL)
+# Chats whose prompt context state is kept; the least recently prompted chat is dropped first
+_CONTEXT_CACHE_CHATS = 64
+# Chats whose message history is held in memory; older ones are reloaded from storage when used again
+_SESSION_CACHE_CHATS = 16
+# start_chat skips the orphaned-process sweep if one ran this recently (seconds)
+_ORPHAN_SCAN_INTERVAL = 30.0
+# Longest a foundry command waits for unload_model's background sweep before giving up (seconds)
+_CLEANUP_WAIT = 10.0
+# Longest restart_with_context waits for a replayed turn's reply before sending the next one
+_REPLAY_TURN_WAIT = 30.0
+# Room for a burst of output while the reader is busy (F_SETPIPE_SZ; the pipe default is 64 KiB)
+_PIPE_SIZE = 1 << 20
+# Assistant replies are framed as <|start|>assistant<|channel|>final<|message|>...<|return|>
+_ASSISTANT_START = "<|start|>assistant<|channel|>final<|message|>"
+_ASSISTANT_END = "<|return|>"
+_NON_BLANK_RE = re.compile(r'\S')
+_MODEL_ID_RE = re.compile(r'([A-Za-z0-9][A-Za-z0-9._-]+)\s*$')
+_ALNUM_RE = re.compile(r'[A-Za-z0-9]')
+_SIZE_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(KB|MB|GB|TB)", re.IGNORECASE)
+_CACHE_ROW_RE = re.compile(r"^\s*(?:💾\s*)?(.+?)\s{2,}([A-Za-z0-9][A-Za-z0-9._-]+)\s*$")
+_SHORT_YES_RE = re.compile(r"(?<![\w-])-y\b")
+_CONFIRM_RE = re.compile(r"y/n|yes/no|confirm", re.IGNORECASE)
+# Deletes table decoration characters; a separator row translates to ''
+_SEP_TBL = str.maketrans('', '', '-─—_=· ')
+_DEVICE_RE = re.compile(r"\s*device\s*[:=]\s*(.+)$", re.IGNORECASE)
+_DML_RE = re.compile(r"\bdml\b")
+_CPU_RE = re.compile(r"\bcpu\b")
+# Every backend rule needs one of these substrings
+_BACKEND_HINTS = ('cuda', 'directml', 'dml', 'rocm', 'mps', 'metal', 'openvino', 'cpu', 'gpu')
+# Every adapter-name rule needs one of these substrings
+_ADAPTER_HINTS = ('gpu', 'adapter', 'device', 'directml', 'dml', 'cuda', 'rocm', 'metal', 'mps')
+# Lines naming the GPU adapter, most explicit first
+_ADAPTER_RES = (
+    re.compile(r"(?:selected|using)\s+(?:d3d12\s+)?(?:adapter|device)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
+    re.compile(r"(?:cuda|nvidia).*(?:device|gpu)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
+    re.compile(r"(?:directml|dml).*(?:device)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
+    re.compile(r"(?:adapter|device)\s*[:=]\s*(NVIDIA.+|AMD.+|Intel.+)$", re.IGNORECASE),
+)
+_VENDOR_RE = re.compile(r"(NVIDIA\s+.+|AMD\s+.+|Intel\s+.+)", re.IGNORECASE)
+_NAME_CUT_RE = re.compile(r"\s*[\[(]|\s\|\s|\s-\s|\s@\s")
+_SPACES_RE = re.compile(r"\s+")
+_PROMPT_RE = re.compile(r"interactive mode.*enter your prompt|interactive chat", re.IGNORECASE)
+# Any of these on `foundry model run` output means the model is available locally
+_READY_RE = re.compile(
+    r"loaded successfully|found in the local cache|interactive mode.*enter your prompt|interactive chat",
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=4)
+def _parse_model_ids(stdout: str) -> Tuple[str, ...]:
+    """Parse model ids from `foundry model list` output, in table order without duplicates."""
+    models: Dict[str, None] = {}  # Insertion-ordered set
+    for raw in stdout.splitlines():
+        s = raw.strip()
+        if not s:
+            continue
+        # Skip obvious headers or separators
+        if 'Model ID' in s or s.startswith('Alias') or s.startswith('Device') or s.startswith('Task'):
+            continue
+        if not s.translate(_SEP_TBL):
+            continue
+        # Extract the last whitespace-separated token (the Model ID column)
+        m = _MODEL_ID_RE.search(s)
+        if not m:
+            continue
+        token = m.group(1).rstrip('-')
+        # Basic sanity: must contain at least one letter or digit and a dash or dot typical of model ids
+        if not _ALNUM_RE.search(token):
+            continue
+        models[token] = None
+    return tuple(models)
+
+
+@lru_cache(maxsize=4)
+def _parse_cache_pairs(stdout: str) -> Tuple[Tuple[str, str], ...]:
+    """Parse (alias, model_id) rows from `foundry cache list` output."""
+    pairs: List[Tuple[str, str]] = []
+    for raw in stdout.splitlines():
+        s = raw.strip()
+        if not s or 'Models cached on device' in s or s.startswith('Alias'):
+            continue
+        if not s.translate(_SEP_TBL):
+            continue
+        # Lines may look like: "💾 gpt-oss-20b                   gpt-oss-20b-cuda-gpu"
+        m = _CACHE_ROW_RE.match(s)
+        if not m:
+            continue
+        alias = m.group(1).strip()
+        model_id = m.group(2).strip()
+        pairs.append((alias, model_id))
+    return tuple(pairs)
+
+
+@lru_cache(maxsize=4)
+def _parse_model_table(stdout: str) -> Tuple[Dict[str, str], List[Tuple[str, str]]]:
+    """Parse `foundry model list` output once into size lookups.
+
+    Returns a dict of lowercased alias/model id -> size hint, and (lowercased row, size hint) pairs in table order.
+    """
+    sizes: Dict[str, str] = {}
+    rows: List[Tuple[str, str]] = []
+    for raw in stdout.splitlines():
+        s = raw.strip()
+        if not s or 'Model ID' in s or s.startswith('Alias'):
+            continue
+        if not s.translate(_SEP_TBL):
+            continue
+        m = _SIZE_RE.search(s)
+        if not m:
+            continue
+        size = f"{m.group(1)} {m.group(2).upper()}"
+        low = s.lower()
+        rows.append((low, size))
+        mid = _MODEL_ID_RE.search(low)
+        if mid:
+            sizes.setdefault(mid.group(1).rstrip('-'), size)
+        # Variant rows leave the alias column blank
+        if not raw[:1].isspace():
+            sizes.setdefault(low.split(None, 1)[0], size)
+    return sizes, rows
+
+
+def _format_turns(messages: List[Dict]) -> str:
+    """Render user and assistant messages as the transcript lines sent ahead of a prompt."""
+    parts = []
+    for msg in messages:
+        if msg["role"] == "user":
+            parts.append(f"User: {msg['content']}")
+        elif msg["role"] == "assistant":
+            parts.append(f"Assistant: {msg['content']}")
+    return "\n".join(parts)
+
+
+def _pump_fd(fd: int, out: "queue.Queue[Optional[bytes]]") -> None:
+    """Copy chunks from a pipe fd into a queue with blocking reads; an empty chunk marks end of stream."""
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            data = b""
+        out.put(data)
+        if not data:
+            return
+
 
 class FoundryCLI:
     """Wrap Foundry Local CLI operations (install, list, run)."""
@@ -28,11 +182,19 @@ class FoundryCLI:
         """Initialize CLI wrapper with proper session tracking."""
         self._proc: Optional[subprocess.Popen] = None
         self._reader_thread: Optional[threading.Thread] = None
-        self._stdout_q: "queue.Queue[str]" = queue.Queue()
         self._stop_event = threading.Event()
-        self._buffer = ""
+        self._ready_event = threading.Event()  # Set by the reader once the chat reports the model ready
+        self._response_complete = threading.Event()  # Set by the reader when an assistant reply ends
+        self._wake_fds: Optional[Tuple[int, int]] = None  # Self-pipe that interrupts the Unix reader's select
+        self._stdin_fd: Optional[int] = None  # Raw stdin fd of the chat process; prompts bypass the file wrapper
+        self._stdout_q: Optional["queue.Queue[Optional[bytes]]"] = None  # Windows pump queue; None wakes the reader
+        self._stdout_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._stdout_pending = ""  # Trailing partial line from the last stdout chunk
+        self._buffer: List[str] = []  # Pending output chunks, joined only when parsed
+        self._buffer_len = 0
         self._device_backend: Optional[str] = None
         self._device_model: Optional[str] = None
+        self._detect_device = True  # Cleared once the chat prompt is reached
         self._token_tracker = get_token_tracker()
         self._current_request_id: Optional[str] = None
         self._current_chat_id: Optional[str] = None
@@ -40,19 +202,32 @@ class FoundryCLI:
         self._gpu_monitor = get_gpu_monitor()
         self._model_loaded: bool = False
         # NEW ATTRIBUTES FOR MEMORY AND SESSION MANAGEMENT
-        self._chat_sessions: Dict[str, List[Dict]] = {}  # Track messages per chat
+        self._chat_sessions: "OrderedDict[str, List[Dict]]" = OrderedDict()  # Track messages per chat, least recently used first
+        self._evicted_sessions: Set[str] = set()  # Chats dropped from _chat_sessions, reloaded from storage on next use
+        self._unsaved_sessions: Dict[str, int] = {}  # Chat id -> history length storage did not fully hold, so it is kept
+        self._sessions_lock = threading.RLock()  # Guards the three above; the reader thread appends replies concurrently
         self._process_cleanup_lock = threading.Lock()  # Thread-safe cleanup
         self._memory_baseline: Optional[int] = None  # Track baseline memory
-        self._context_cache: Dict[str, str] = {}  # Cache formatted contexts
+        # Per-chat context state: messages covered, last covered message, their formatted copies, token total, rendered text
+        self._context_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self._context_mgr = ContextManager(max_tokens=4096, reserve_tokens=512)
         self._on_raw_output: Optional[Callable[[str], None]] = None
         self._on_assistant: Optional[Callable[[str], None]] = None
-        self._flush_secs: float = 0.4
+        self._flush_ns: int = 400_000_000  # Fallback flush interval of the streamed-output buffer
+        self._last_flush_ns: Optional[int] = None  # time.monotonic_ns() of the last timed flush
+        self._remove_flags: Optional[List[str]] = None  # Confirmation flag accepted by `foundry cache remove`
+        self._list_cache: Dict[Tuple[str, ...], Tuple[float, str]] = {}  # argv -> (monotonic time, stdout)
+        self._last_orphan_scan: Optional[float] = None  # Monotonic time of the last orphaned-process sweep
+        self._cleanup_thread: Optional[threading.Thread] = None  # Orphan sweep left running by unload_model
 
     def is_installed(self) -> bool:
         """Return True if the `foundry` command is available."""
+        # Resolve on PATH first; spawning `foundry --version` is only needed when lookup misses (e.g. app execution aliases)
+        if shutil.which("foundry"):
+            return True
         try:
             flags = getattr(subprocess, 'CREATE_NO_WINDOW', 0) if os.name == 'nt' else 0
-            subprocess.run(["foundry", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False, creationflags=flags)
+            subprocess.run(["foundry", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False, creationflags=flags)
             return True
         except FileNotFoundError:
             return False
@@ -95,6 +270,24 @@ class FoundryCLI:
             p.wait()
             return p.returncode or 0
 
+    def _foundry_stdout(self, args: Tuple[str, ...], ttl: float = 2.0) -> str:
+        """Return stdout of `foundry <args>`, reusing a result captured less than `ttl` seconds ago.
+
+        Raises FileNotFoundError when the `foundry` command is not available.
+        """
+        now = time.monotonic()
+        hit = self._list_cache.get(args)
+        if hit and now - hit[0] < ttl:
+            return hit[1]
+        # A process started during the unload sweep would be killed by it
+        if not self._wait_for_cleanup():
+            return ""
+        # Capture bytes and decode once; the table parsers split with splitlines(), so no newline translation is needed
+        cp = subprocess.run(["foundry", *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        out = (cp.stdout or b'').decode('utf-8', 'replace')
+        self._list_cache[args] = (now, out)
+        return out
+
     def list_models(self) -> List[str]:
         """
         Return a best-effort parsed list of available model names from `foundry model list`.
@@ -103,33 +296,10 @@ class FoundryCLI:
             - list[str]: Model identifiers
         """
         try:
-            cp = subprocess.run(["foundry", "model", "list"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', check=False, creationflags=subprocess.CREATE_NO_WINDOW)
+            stdout = self._foundry_stdout(("model", "list"))
         except FileNotFoundError:
             return []
-        out = cp.stdout.splitlines()
-        models: List[str] = []
-        seen: set[str] = set()
-        for raw in out:
-            s = raw.strip()
-            if not s:
-                continue
-            # Skip obvious headers or separators
-            if 'Model ID' in s or s.startswith('Alias') or s.startswith('Device') or s.startswith('Task'):
-                continue
-            if set(s) <= set('-─—_=· '):
-                continue
-            # Extract the last whitespace-separated token (the Model ID column)
-            m = re.search(r'([A-Za-z0-9][A-Za-z0-9._-]+)\s*$', s)
-            if not m:
-                continue
-            token = m.group(1).rstrip('-')
-            # Basic sanity: must contain at least one letter or digit and a dash or dot typical of model ids
-            if not re.search(r'[A-Za-z0-9]', token):
-                continue
-            if token not in seen:
-                seen.add(token)
-                models.append(token)
-        return models
+        return list(_parse_model_ids(stdout))
 
     def model_size_hint(self, name: str) -> Optional[str]:
         """Return a best-effort size hint like '4.2 GB' for a model from `foundry model list`.
@@ -137,23 +307,17 @@ class FoundryCLI:
         Tries to find a table row matching the alias or model id and extract an 'XX [KMG]B' token.
         """
         try:
-            cp = subprocess.run(["foundry", "model", "list"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', check=False, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+            stdout = self._foundry_stdout(("model", "list"))
         except FileNotFoundError:
             return None
         target = name.strip().lower()
-        size_re = re.compile(r"(\d+(?:\.\d+)?)\s*(KB|MB|GB|TB)", re.IGNORECASE)
-        for raw in (cp.stdout or '').splitlines():
-            s = raw.strip()
-            if not s or 'Model ID' in s or s.startswith('Alias'):
-                continue
-            if set(s) <= set('-─—_=· '):
-                continue
-            low = s.lower()
-            if target not in low:
-                continue
-            m = size_re.search(s)
-            if m:
-                return f"{m.group(1)} {m.group(2).upper()}"
+        sizes, rows = _parse_model_table(stdout)
+        if target in sizes:
+            return sizes[target]
+        # Fall back to a partial match anywhere in a row
+        for low, size in rows:
+            if target in low:
+                return size
         return None
 
     def start_chat(self, model: str, on_raw_output: Optional[Callable[[str], None]] = None,
@@ -162,10 +326,14 @@ class FoundryCLI:
         """Start chat with proper process management."""
         # Clean up any existing session first
         if self._proc:
+            # stop_chat waits for the process and joins its reader thread
             self.stop_chat()
-            time.sleep(1.0)  # Wait for cleanup
-        # Kill any orphaned processes before starting
-        self._kill_orphaned_processes()
+        # An unload's background sweep must finish before the new process exists, or it would kill it
+        if not self._wait_for_cleanup():
+            raise RuntimeError("Failed to start chat: model cleanup is still running")
+        # Kill any orphaned processes before starting; a recent sweep already covered this
+        if self._last_orphan_scan is None or time.monotonic() - self._last_orphan_scan >= _ORPHAN_SCAN_INTERVAL:
+            self._kill_orphaned_processes()
         # Record baseline memory
         if self._gpu_monitor:
             info = self._gpu_monitor.get_gpu_memory_usage()
@@ -175,8 +343,16 @@ class FoundryCLI:
         self.ensure_model_downloaded(model)
         self._on_raw_output = on_raw_output
         self._on_assistant = on_assistant
-        self._flush_secs = flush_secs
-        self._stop_event.clear()        
+        # Validate the flush interval once rather than trusting it on every streamed line
+        try:
+            self._flush_ns = int(float(flush_secs) * 1e9)
+        except (TypeError, ValueError, OverflowError):
+            self._flush_ns = 400_000_000
+        if self._flush_ns <= 0:
+            self._flush_ns = 400_000_000
+        self._stop_event.clear()
+        self._ready_event.clear()
+        self._detect_device = True        
         try:
             # Platform-specific process creation
             if os.name == 'nt':
@@ -200,8 +376,14 @@ class FoundryCLI:
                     text=True,
                     bufsize=0
                 )
+                if fcntl is not None:
+                    try:
+                        fcntl.fcntl(self._proc.stdout.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), _PIPE_SIZE)
+                    except OSError:
+                        pass  # Not Linux, or above the pipe-max-size limit
             if not self._proc:
                 raise RuntimeError("Failed to start Foundry process")            
+            self._stdin_fd = self._proc.stdin.fileno()
             self._model_loaded = True
             self._current_model = model
             # Start reader thread
@@ -211,16 +393,12 @@ class FoundryCLI:
                 daemon=True
             )
             self._reader_thread.start()
-            # Wait for model to be ready
-            ready_timeout = 60
-            ready_start = time.time()
-            while time.time() - ready_start < ready_timeout:
+            # Wait for the reader to see a ready line; without one, assume ready after a brief delay
+            ready_deadline = time.monotonic() + 3
+            while not self._ready_event.wait(0.25):
                 if self._proc.poll() is not None:
                     raise RuntimeError(f"Process terminated unexpectedly with code {self._proc.returncode}")
-                # Check if model is ready (you may need to adjust this based on Foundry's output)
-                time.sleep(0.5)
-                # For now, assume ready after a brief delay
-                if time.time() - ready_start > 3:
+                if time.monotonic() >= ready_deadline:
                     break
             print(f"Chat started with model: {model}", flush=True)
         except Exception as e:
@@ -241,43 +419,53 @@ class FoundryCLI:
         """Return the detected GPU model string if available (e.g., 'NVIDIA GeForce RTX 3080')."""
         return self._device_model
 
-    def _detect_device_backend(self, s: str) -> Optional[str]:
-        """Return a normalized accelerator name if a line indicates device backend."""
+    def _detect_device_backend(self, s: str, low: Optional[str] = None) -> Optional[str]:
+        """Return a normalized accelerator name if a line indicates device backend.
+
+        `low` may be passed as the already stripped and lowercased line.
+        """
         txt = (s or '').strip()
-        low = txt.lower()
-        m = re.match(r"\s*device\s*[:=]\s*(.+)$", txt, re.IGNORECASE)
+        if low is None:
+            low = txt.lower()
+        m = _DEVICE_RE.match(txt)
         if m:
             val = m.group(1).strip()
             return self._normalize_backend_name(val)
+        # Screen out the common line that names no backend before the specific rules
+        for k in _BACKEND_HINTS:
+            if k in low:
+                break
+        else:
+            return None
         if any(k in low for k in ('accelerator', 'backend', 'runtime')) and any(k in low for k in ('cuda','directml','dml','rocm','mps','metal','openvino','cpu','gpu')):
-            return self._normalize_backend_name(txt)
+            return self._normalize_backend_name(txt, low)
         if 'model id' in low and any(x in low for x in ('-cuda-gpu','-dml-gpu','-rocm-gpu','-cpu','-metal-gpu','-mps')):
-            return self._normalize_backend_name(txt)
+            return self._normalize_backend_name(txt, low)
         if any(k in low for k in ('cuda','directml',' dml ','rocm','mps','metal','openvino')):
-            return self._normalize_backend_name(txt)
+            return self._normalize_backend_name(txt, low)
         return None
 
-    def _detect_device_model(self, s: str) -> Optional[str]:
+    def _detect_device_model(self, s: str, low: Optional[str] = None) -> Optional[str]:
         """Attempt to extract a detailed GPU model name from CLI output lines."""
         txt = (s or '').strip()
         if not txt:
             return None
-        low = txt.lower()
+        if low is None:
+            low = txt.lower()
+        for k in _ADAPTER_HINTS:
+            if k in low:
+                break
+        else:
+            return None
         # Common patterns that include explicit adapter/device label
-        pats = [
-            re.compile(r"(?:selected|using)\s+(?:d3d12\s+)?(?:adapter|device)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
-            re.compile(r"(?:cuda|nvidia).*(?:device|gpu)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
-            re.compile(r"(?:directml|dml).*(?:device)\s*[:=]\s*['\"]?(.+?)['\"]?$", re.IGNORECASE),
-            re.compile(r"(?:adapter|device)\s*[:=]\s*(NVIDIA.+|AMD.+|Intel.+)$", re.IGNORECASE),
-        ]
-        for r in pats:
+        for r in _ADAPTER_RES:
             m = r.search(txt)
             if m:
                 val = m.group(1).strip()
                 return self._clean_model_name(val)
         # Heuristic: if a line mentions a known vendor and GPU context, capture substring from vendor
         if any(k in low for k in ('nvidia','geforce','quadro','tesla','amd','radeon','vega','intel','arc','iris')) and any(k in low for k in ('gpu','adapter','device','directml','dml','cuda','rocm','metal','mps')):
-            m2 = re.search(r"(NVIDIA\s+.+|AMD\s+.+|Intel\s+.+)", txt, re.IGNORECASE)
+            m2 = _VENDOR_RE.search(txt)
             if m2:
                 return self._clean_model_name(m2.group(1))
         return None
@@ -286,19 +474,20 @@ class FoundryCLI:
         """Normalize a raw adapter string to a concise GPU model name."""
         s = (val or '').strip().strip('\"\'')
         # Cut off trailing descriptors like memory, driver, or brackets/parentheses
-        s = re.split(r"\s*[\[(]|\s\|\s|\s-\s|\s@\s", s)[0].strip()
+        s = _NAME_CUT_RE.split(s, 1)[0].strip()
         # Remove trademark symbols
         s = s.replace('(TM)', '').replace('(R)', '').replace('®', '').replace('™', '').strip()
         # Collapse whitespace
-        s = re.sub(r"\s+", " ", s)
+        s = _SPACES_RE.sub(" ", s)
         return s
 
-    def _normalize_backend_name(self, raw: str) -> Optional[str]:
+    def _normalize_backend_name(self, raw: str, low: Optional[str] = None) -> Optional[str]:
         """Map arbitrary device strings into a concise label."""
-        low = (raw or '').lower()
+        if low is None:
+            low = (raw or '').lower()
         if 'cuda' in low or 'nvidia' in low:
             return 'CUDA GPU'
-        if 'directml' in low or re.search(r"\bdml\b", low):
+        if 'directml' in low or ('dml' in low and _DML_RE.search(low)):
             return 'DirectML GPU'
         if 'rocm' in low or 'amd' in low:
             return 'ROCm GPU'
@@ -306,7 +495,7 @@ class FoundryCLI:
             return 'Metal GPU'
         if 'openvino' in low:
             return 'OpenVINO'
-        if re.search(r"\bcpu\b", low):
+        if 'cpu' in low and _CPU_RE.search(low):
             return 'CPU'
         if 'gpu' in low:
             return 'GPU'
@@ -315,42 +504,54 @@ class FoundryCLI:
     def list_cached_pairs(self) -> List[Tuple[str, str]]:
         """Return a list of (alias, model_id) for models present in the local cache."""
         try:
-            cp = subprocess.run(["foundry", "cache", "list"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', check=False, creationflags=subprocess.CREATE_NO_WINDOW)
+            stdout = self._foundry_stdout(("cache", "list"))
         except FileNotFoundError:
             return []
-        pairs: List[Tuple[str, str]] = []
-        for raw in (cp.stdout or '').splitlines():
-            s = raw.strip()
-            if not s or 'Models cached on device' in s or s.startswith('Alias'):
-                continue
-            if set(s) <= set('-─—_=· '):
-                continue
-            # Lines may look like: "💾 gpt-oss-20b                   gpt-oss-20b-cuda-gpu"
-            m = re.match(r"^\s*(?:💾\s*)?(.+?)\s{2,}([A-Za-z0-9][A-Za-z0-9._-]+)\s*$", s)
-            if not m:
-                continue
-            alias = m.group(1).strip()
-            model_id = m.group(2).strip()
-            pairs.append((alias, model_id))
-        return pairs
+        return list(_parse_cache_pairs(stdout))
+
+    def _cache_remove_cmds(self, target: str) -> List[List[str]]:
+        """Return the `foundry cache remove` command(s) to try for a target.
+
+        Probes `foundry cache remove --help` once to learn which confirmation flag is accepted;
+        if the help text cannot be read, every known variant is returned to try in order.
+        """
+        if self._remove_flags is None:
+            try:
+                cp = subprocess.run(["foundry", "cache", "remove", "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace', timeout=30, check=False, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+                help_text = cp.stdout or ''
+            except (FileNotFoundError, subprocess.TimeoutExpired):
+                help_text = ''
+            if '--yes' in help_text:
+                self._remove_flags = ['--yes']
+            elif _SHORT_YES_RE.search(help_text):
+                self._remove_flags = ['-y']
+            elif help_text.strip():
+                self._remove_flags = []
+        if self._remove_flags is not None:
+            return [["foundry", "cache", "remove", *self._remove_flags, target]]
+        return [
+            ["foundry", "cache", "remove", "--yes", target],
+            ["foundry", "cache", "remove", "-y", target],
+            ["foundry", "cache", "remove", target],
+        ]
 
     def remove_cached_model(self, name: str) -> bool:
         """Remove a cached model by model id or alias using `foundry cache remove`.
 
         Tries the provided name first; on failure, resolves via alias↔id pairs and retries.
         """
+        if not self._wait_for_cleanup():
+            return False
         flags = getattr(subprocess, 'CREATE_NO_WINDOW', 0) if os.name == 'nt' else 0
         def _rm(target: str) -> bool:
-            # Try with explicit non-interactive flags first; fall back to piping "y" to handle confirmation prompts.
-            cmds = [
-                ["foundry", "cache", "remove", "--yes", target],
-                ["foundry", "cache", "remove", "-y", target],
-                ["foundry", "cache", "remove", target],
-            ]
-            for cmd in cmds:
+            # Use the non-interactive flag when supported; "y" is also piped to handle confirmation prompts.
+            for cmd in self._cache_remove_cmds(target):
                 try:
                     cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', input='y\n', timeout=120, check=False, creationflags=flags)
                     if (cp.returncode or 0) == 0:
+                        self._list_cache.clear()
+                        # Remember the accepted form so later removals spawn a single process
+                        self._remove_flags = cmd[3:-1]
                         return True
                 except subprocess.TimeoutExpired:
                     return False
@@ -364,12 +565,14 @@ class FoundryCLI:
         alias_to_id = {a: mid for a, mid in pairs}
         id_to_alias = {mid: a for a, mid in pairs}
         candidate = alias_to_id.get(name) or id_to_alias.get(name)
-        if candidate and _rm(candidate):
+        if candidate and candidate != name and _rm(candidate):
             return True
         return False
 
     def remove_cached_model_stream(self, name: str, on_output: Optional[Callable[[str], None]] = None) -> bool:
         """Remove a cached model by id or alias while streaming CLI output to a callback."""
+        if not self._wait_for_cleanup():
+            return False
         flags = getattr(subprocess, 'CREATE_NO_WINDOW', 0) if os.name == 'nt' else 0
         def _emit(s: str) -> None:
             try:
@@ -378,12 +581,7 @@ class FoundryCLI:
             except Exception:
                 pass
         def _rm_stream(target: str) -> bool:
-            cmds = [
-                ["foundry", "cache", "remove", "--yes", target],
-                ["foundry", "cache", "remove", "-y", target],
-                ["foundry", "cache", "remove", target],
-            ]
-            for cmd in cmds:
+            for cmd in self._cache_remove_cmds(target):
                 try:
                     p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace', bufsize=1, creationflags=flags)
                 except FileNotFoundError:
@@ -396,7 +594,7 @@ class FoundryCLI:
                             _emit(s)
                         # Best-effort: auto-confirm if we see a prompt
                         try:
-                            if p.stdin and re.search(r"(y/n|yes/no|confirm)", s, re.IGNORECASE):
+                            if p.stdin and _CONFIRM_RE.search(s):
                                 p.stdin.write('y\n')
                                 p.stdin.flush()
                         except Exception:
@@ -408,6 +606,9 @@ class FoundryCLI:
                 except Exception:
                     pass
                 if p.returncode == 0:
+                    self._list_cache.clear()
+                    # Remember the accepted form so later removals spawn a single process
+                    self._remove_flags = cmd[3:-1]
                     return True
             return False
         if _rm_stream(name):
@@ -416,7 +617,7 @@ class FoundryCLI:
         alias_to_id = {a: mid for a, mid in pairs}
         id_to_alias = {mid: a for a, mid in pairs}
         candidate = alias_to_id.get(name) or id_to_alias.get(name)
-        if candidate and _rm_stream(candidate):
+        if candidate and candidate != name and _rm_stream(candidate):
             return True
         return False
 
@@ -431,35 +632,36 @@ class FoundryCLI:
         Returns:
             - bool: True if model loaded successfully; False otherwise
         """
+        if not self._wait_for_cleanup():
+            return False
         flags = getattr(subprocess, 'CREATE_NO_WINDOW', 0) if os.name == 'nt' else 0
         try:
             p = subprocess.Popen(["foundry", "model", "run", model], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace', creationflags=flags)
         except FileNotFoundError:
             return False
         ok = False
-        ready_res = [
-            re.compile(r"loaded successfully", re.IGNORECASE),
-            re.compile(r"found in the local cache", re.IGNORECASE),
-            re.compile(r"interactive mode.*enter your prompt", re.IGNORECASE),
-            re.compile(r"interactive chat", re.IGNORECASE),
-        ]
-        deadline = time.time() + 300
         assert p.stdout is not None
-        for line in p.stdout:
-            s = line.rstrip('\n')
-            if on_output:
-                on_output(s)
-            if any(r.search(s) for r in ready_res):
-                ok = True
-                try:
-                    if p.stdin:
-                        p.stdin.write('/exit\n')
-                        p.stdin.flush()
-                except Exception:
-                    pass
-                break
-            if time.time() > deadline:
-                break
+        # Enforce the deadline even while the CLI prints nothing; killing the child ends the read loop
+        watchdog = threading.Timer(300, p.kill)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            for line in p.stdout:
+                s = line.rstrip('\n')
+                if on_output:
+                    on_output(s)
+                if _READY_RE.search(s):
+                    ok = True
+                    self._list_cache.clear()
+                    try:
+                        if p.stdin:
+                            p.stdin.write('/exit\n')
+                            p.stdin.flush()
+                    except Exception:
+                        pass
+                    break
+        finally:
+            watchdog.cancel()
         try:
             if p and p.poll() is None:
                 p.terminate()
@@ -483,10 +685,8 @@ class FoundryCLI:
             return None
         # Initialize chat session if needed
         if chat_id:
-            if chat_id not in self._chat_sessions:
-                self._chat_sessions[chat_id] = []
             # Store the message in session history
-            self._chat_sessions[chat_id].append({
+            self._session(chat_id).append({
                 "role": "user",
                 "content": prompt,
                 "timestamp": time.time()
@@ -498,23 +698,17 @@ class FoundryCLI:
             full_prompt = context + prompt if context else prompt
         else:
             full_prompt = prompt
-        # Generate request ID for tracking
-        req_id = f"req_{int(time.time() * 1000)}"
-        self._current_request_id = req_id
-        # Track tokens
+        # Track tokens; the tracker's request id is what complete_request looks up
         if self._current_chat_id:
-            self._token_tracker.start_request(req_id, full_prompt, self._current_chat_id)
+            req_id = self._token_tracker.start_request(self._current_chat_id, full_prompt, self._current_model)
+        else:
+            req_id = f"req_{int(time.time() * 1000)}"
+        self._current_request_id = req_id
         try:
-            # Encode properly for Windows
-            if os.name == 'nt':
-                # Windows requires specific encoding handling
-                encoded_prompt = (full_prompt + "\n").encode('utf-8', errors='replace')
-                self._proc.stdin.buffer.write(encoded_prompt)
-                self._proc.stdin.buffer.flush()
-            else:
-                # Unix systems can use text mode
-                self._proc.stdin.write(full_prompt + "\n")
-                self._proc.stdin.flush()
+            # Write straight to the fd: one encode, no wrapper buffering and no separate flush
+            payload = memoryview((full_prompt + "\n").encode('utf-8', errors='replace'))
+            while payload:
+                payload = payload[os.write(self._stdin_fd, payload):]
             return req_id
         except (OSError, IOError, BrokenPipeError) as e:
             print(f"Error sending prompt (pipe broken): {e}", flush=True)
@@ -526,20 +720,31 @@ class FoundryCLI:
             return None
     def _read_output(self) -> None:
         """Read output with proper non-blocking I/O and timeout handling."""
-        import select
-        acc = []
-        last_flush = time.time()
         last_activity_time = time.time()
         timeout_duration = 30 if os.environ.get('PYTEST_CURRENT_TEST') else 60
-        # Set non-blocking mode for Unix systems
-        if os.name != 'nt' and self._proc and self._proc.stdout:
-            try:
-                import fcntl
-                fd = self._proc.stdout.fileno()
-                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
-                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-            except ImportError:
-                pass  # fcntl not available on Windows        
+        selector = None
+        stdout_q: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._stdout_q = stdout_q
+        if self._proc and self._proc.stdout:
+            # Read raw chunks from the fd; file-object buffering would hide lines from select
+            fd = self._proc.stdout.fileno()
+            self._stdout_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            self._stdout_pending = ""
+        if os.name == 'nt' and self._proc and self._proc.stdout:
+            # Windows pipes cannot be selected on; one long-lived thread does the blocking reads
+            threading.Thread(target=_pump_fd, args=(fd, stdout_q), name="FoundryWinReader", daemon=True).start()
+        elif self._proc and self._proc.stdout:
+            # Set non-blocking mode for Unix systems
+            os.set_blocking(fd, False)
+            # Wait on stdout and the wake pipe together so stop requests interrupt select immediately
+            if self._wake_fds is None:
+                self._wake_fds = os.pipe()
+                for wfd in self._wake_fds:
+                    os.set_blocking(wfd, False)
+            self._drain_wake_pipe()
+            selector = selectors.DefaultSelector()
+            selector.register(self._proc.stdout, selectors.EVENT_READ)
+            selector.register(self._wake_fds[0], selectors.EVENT_READ)
         while not self._stop_event.is_set():
             try:
                 if not self._proc or not self._proc.stdout:
@@ -549,44 +754,45 @@ class FoundryCLI:
                     # Process terminated, read any remaining output
                     try:
                         if os.name == 'nt':
-                            # Windows: read remaining binary data
-                            remaining = self._proc.stdout.buffer.read()
-                            if remaining:
-                                text = remaining.decode('utf-8', errors='replace')
-                                for line in text.splitlines():
-                                    self._process_line(line)
+                            # Windows: take what the pump thread still delivers
+                            while True:
+                                try:
+                                    data = stdout_q.get(timeout=0.5)
+                                except queue.Empty:
+                                    break
+                                if not data:
+                                    break
+                                self._feed_output(data)
+                            self._finish_output()
                         else:
-                            # Unix: read remaining text
-                            remaining = self._proc.stdout.read()
-                            if remaining:
-                                for line in remaining.splitlines():
-                                    self._process_line(line)
+                            # Unix: drain whatever is left in the pipe
+                            while True:
+                                try:
+                                    data = os.read(fd, 65536)
+                                except BlockingIOError:
+                                    break
+                                if not data:
+                                    break
+                                self._feed_output(data)
+                            self._finish_output()
                     except:
                         pass
                     break
                 # Platform-specific non-blocking read
                 if os.name == 'nt':
-                    # Windows: Use threading with timeout
-                    import queue as q
-                    import threading
-                    line_queue = q.Queue()
-                    def read_line():
-                        try:
-                            # Read binary data on Windows
-                            raw_line = self._proc.stdout.buffer.readline()
-                            if raw_line:
-                                line = raw_line.decode('utf-8', errors='replace')
-                                line_queue.put(line)
-                        except:
-                            pass
-                    reader = threading.Thread(target=read_line)
-                    reader.daemon = True
-                    reader.start()
+                    # Windows: consume chunks from the pump thread with a timeout
                     try:
-                        line = line_queue.get(timeout=0.5)
-                        self._process_line(line.rstrip('\n'))
+                        data = stdout_q.get(timeout=0.5)
+                        if data is None:
+                            # Woken by a stop request; the loop condition handles it
+                            continue
+                        if not data:
+                            # Child closed stdout; nothing more will arrive
+                            self._finish_output()
+                            break
+                        self._feed_output(data)
                         last_activity_time = time.time()
-                    except q.Empty:
+                    except queue.Empty:
                         # No data available
                         if time.time() - last_activity_time > timeout_duration:
                             print(f"Reader thread timeout after {timeout_duration}s", flush=True)
@@ -594,18 +800,25 @@ class FoundryCLI:
                 else:
                     # Unix: Use select for non-blocking read
                     try:
-                        ready, _, _ = select.select([self._proc.stdout], [], [], 0.5)
-                        
+                        ready = [key.fileobj for key, _ in selector.select(0.5)]
+                        if self._wake_fds[0] in ready:
+                            self._drain_wake_pipe()
+                            continue
                         if ready:
                             try:
-                                line = self._proc.stdout.readline()
-                                if line:
-                                    self._process_line(line.rstrip('\n'))
-                                    last_activity_time = time.time()
-                            except (IOError, OSError) as e:
-                                if e.errno != 11:  # EAGAIN
-                                    print(f"Read error: {e}", flush=True)
-                                    break
+                                data = os.read(fd, 65536)
+                            except BlockingIOError:
+                                data = None
+                            except OSError as e:
+                                print(f"Read error: {e}", flush=True)
+                                break
+                            if data == b"":
+                                # Child closed stdout; nothing more will arrive
+                                self._finish_output()
+                                break
+                            if data:
+                                self._feed_output(data)
+                                last_activity_time = time.time()
                         else:
                             # Check for timeout
                             if time.time() - last_activity_time > timeout_duration:
@@ -614,84 +827,156 @@ class FoundryCLI:
                     except Exception as e:
                         print(f"Select error: {e}", flush=True)
                         time.sleep(0.1)
-                # Sleep briefly to prevent CPU spinning
-                time.sleep(0.01)
             except Exception as e:
                 if not self._stop_event.is_set():
                     print(f"Reader thread error: {e}", flush=True)
                 break
+        if selector:
+            selector.close()
         print("Reader thread exiting", flush=True)
 
+    def _feed_output(self, data: bytes) -> None:
+        """Decode a raw stdout chunk and process every line it completes."""
+        text = self._stdout_pending + self._stdout_decoder.decode(data)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        *lines, self._stdout_pending = text.split('\n')
+        for line in lines:
+            self._process_line(line)
+
+    def _finish_output(self) -> None:
+        """Process the trailing partial line once stdout has ended."""
+        tail = self._stdout_pending + self._stdout_decoder.decode(b"", final=True)
+        self._stdout_pending = ""
+        self._process_line(tail)
+
+    def _drain_wake_pipe(self) -> None:
+        """Discard pending wake-up bytes so the next select blocks normally."""
+        try:
+            while os.read(self._wake_fds[0], 512):
+                pass
+        except (OSError, TypeError):
+            pass
+
+    def _close_wake_pipe(self) -> None:
+        """Close both ends of the reader's wake pipe; the next reader creates a new one."""
+        fds, self._wake_fds = self._wake_fds, None
+        for wfd in fds or ():
+            try:
+                os.close(wfd)
+            except OSError:
+                pass
+
+    def _wake_reader(self) -> None:
+        """Signal the reader thread to stop and interrupt it if it is waiting on select."""
+        self._stop_event.set()
+        if self._stdout_q is not None:
+            self._stdout_q.put(None)
+        if self._wake_fds:
+            try:
+                os.write(self._wake_fds[1], b"\0")
+            except OSError:
+                pass
+
     def _process_line(self, line: str) -> None:
         """Process a single line of output."""
         if not line:
             return
-        # Queue the line
-        try:
-            self._stdout_q.put(line)
-        except:
-            pass
         # Call raw output handler
         if self._on_raw_output:
             try:
                 self._on_raw_output(line)
             except Exception:
                 pass        
-        # Detect device backend
-        backend = self._detect_device_backend(line)
-        if backend:
-            self._device_backend = backend
-        # Detect device model
-        model = self._detect_device_model(line)
-        if model:
-            self._device_model = model
+        # Device lines are only printed while the model starts; stop scanning once the prompt appears
+        if self._detect_device:
+            txt = line.strip()
+            low = txt.lower()
+            # Detect device backend
+            backend = self._detect_device_backend(txt, low)
+            if backend:
+                self._device_backend = backend
+            # Detect device model
+            model = self._detect_device_model(txt, low)
+            if model:
+                self._device_model = model
+            if _READY_RE.search(line):
+                self._ready_event.set()
+                if _PROMPT_RE.search(line):
+                    self._detect_device = False
         # Buffer for assistant messages
-        self._buffer += line + "\n"
-        # Check for assistant message pattern
-        match = _ASSISTANT_BLOCK_RE.search(self._buffer)
-        if match:
-            # Extract and process assistant message
-            content = match.group(1).strip()
-            if content:
-                self._on_assistant_msg(content)
+        chunk = line + "\n"
+        self._buffer.append(chunk)
+        self._buffer_len += len(chunk)
+        # Complete blocks are always consumed, so only a new end marker can complete another one
+        if _ASSISTANT_END in line:
+            text = "".join(self._buffer)
+            end = 0
+            # Each block runs from an opening sentinel to the first end marker after it
+            while True:
+                start = text.find(_ASSISTANT_START, end)
+                if start < 0:
+                    break
+                start += len(_ASSISTANT_START)
+                stop = text.find(_ASSISTANT_END, start)
+                if stop < 0:
+                    break
+                # Extract and process assistant message
+                content = text[start:stop].strip()
+                if content:
+                    self._on_assistant_msg(content)
+                end = stop + len(_ASSISTANT_END)
             # Clear the processed part from buffer
-            self._buffer = self._buffer[match.end():]
+            if end:
+                rest = text[end:]
+                self._buffer = [rest] if rest else []
+                self._buffer_len = len(rest)
         # Flush buffer periodically
         self._flush_buffer_if_needed()
 
     def _flush_buffer_if_needed(self) -> None:
         """Flush buffer if timeout reached or buffer is large."""
-        now = time.time()
+        now = time.monotonic_ns()
         # Check if we should flush based on time
-        if hasattr(self, '_last_flush_time'):
-            if now - self._last_flush_time >= self._flush_secs:
-                self._flush_buffer()
-                self._last_flush_time = now
-        else:
-            self._last_flush_time = now
+        if self._last_flush_ns is None:
+            self._last_flush_ns = now
+        elif now - self._last_flush_ns >= self._flush_ns:
+            self._flush_buffer()
+            self._last_flush_ns = now
         # Also flush if buffer is getting large
-        if len(self._buffer) > 4096:
+        if self._buffer_len > 4096:
             self._flush_buffer()
 
     def _flush_buffer(self) -> None:
         """Flush any remaining content in the buffer."""
-        if self._buffer and self._on_assistant:
-            # Only flush if it looks like content (not just whitespace)
-            content = self._buffer.strip()
-            if content and not content.startswith('<|'):
-                # This might be fallback content
-                try:
-                    self._on_assistant(content)
-                except:
-                    pass
-            self._buffer = ""
+        if not self._buffer:
+            return
+        if self._on_assistant:
+            # Only flush if it looks like content (not just whitespace); the first non-blank character
+            # decides that, so whitespace-only and sentinel buffers are dropped without joining them
+            for part in self._buffer:
+                m = _NON_BLANK_RE.search(part)
+                if not m:
+                    continue
+                if not part.startswith('<|', m.start()):
+                    content = "".join(self._buffer).strip()
+                    if not content.startswith('<|'):
+                        # This might be fallback content
+                        try:
+                            self._on_assistant(content)
+                        except:
+                            pass
+                break
+        # Drop the flushed text even without a listener so the buffer stays bounded
+        self._buffer = []
+        self._buffer_len = 0
 
     def _handle_process_death(self) -> None:
         """Handle unexpected process termination."""
         print("Handling unexpected process termination...", flush=True)
         self._model_loaded = False
         # Stop the reader thread
-        self._stop_event.set()
+        self._wake_reader()
         # Clean up the dead process
         if self._proc:
             try:
@@ -710,38 +995,36 @@ class FoundryCLI:
 
     def _build_context_for_chat(self, chat_id: str) -> str:
         """Build context from chat history with intelligent truncation."""
-        if chat_id not in self._chat_sessions:
-            return ""
-        # Check cache first
-        cache_key = f"{chat_id}_{len(self._chat_sessions[chat_id])}"
-        if cache_key in self._context_cache:
-            return self._context_cache[cache_key]
-        messages = self._chat_sessions[chat_id]
+        messages = self._chat_sessions.get(chat_id)
         if not messages:
             return ""
-        # Use context manager for intelligent truncation
-        from .context_manager import ContextManager
-        context_mgr = ContextManager(max_tokens=4096, reserve_tokens=512)
-        # Convert to format expected by context manager
-        formatted_messages = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in messages[:-1]  # Exclude current message
-        ]
-        # Get truncated messages that fit in context window
-        truncated = context_mgr.truncate_messages(formatted_messages)
-        # Build context string
-        context_parts = []
-        for msg in truncated:
-            if msg["role"] == "user":
-                context_parts.append(f"User: {msg['content']}")
-            elif msg["role"] == "assistant":
-                context_parts.append(f"Assistant: {msg['content']}")
-        context = "\n".join(context_parts)
-        if context:
-            context += "\n\n"
-        # Cache the context
-        self._context_cache[cache_key] = context
-        return context
+        n = len(messages) - 1  # Exclude current message
+        state = self._context_cache.get(chat_id)
+        # Start over if the session list changed underneath the messages already accounted for
+        if state is None or state["count"] > n or (state["count"] and messages[state["count"] - 1] is not state["last"]):
+            state = {"count": 0, "last": None, "formatted": [], "tokens": 0, "body": ""}
+            self._context_cache[chat_id] = state
+        self._context_cache.move_to_end(chat_id)
+        if len(self._context_cache) > _CONTEXT_CACHE_CHATS:
+            self._context_cache.popitem(last=False)
+        added = messages[state["count"]:n]
+        if added:
+            # Convert to format expected by context manager
+            formatted_added = [{"role": msg["role"], "content": msg["content"]} for msg in added]
+            state["formatted"].extend(formatted_added)
+            state["tokens"] += self._context_mgr.estimate_total_tokens(formatted_added)
+            state["count"] = n
+            state["last"] = messages[n - 1]
+            if state["tokens"] < self._context_mgr.available_tokens:
+                # Everything fits, so truncation would keep every message as-is; render only the new turns
+                parts = _format_turns(formatted_added)
+                if parts:
+                    state["body"] = state["body"] + "\n" + parts if state["body"] else parts
+            else:
+                # Get truncated messages that fit in context window
+                state["body"] = _format_turns(self._context_mgr.truncate_messages(state["formatted"]))
+        body = state["body"]
+        return body + "\n\n" if body else ""
 
     def _on_assistant_msg(self, txt: str) -> None:
         """Handle assistant messages with proper tracking."""
@@ -749,61 +1032,120 @@ class FoundryCLI:
             self._on_assistant(txt)
         # Store assistant response in session
         if self._current_chat_id:
-            self._chat_sessions[self._current_chat_id].append({
+            self._append_turn(self._current_chat_id, {
                 "role": "assistant",
                 "content": txt,
                 "timestamp": time.time()
             })
-            
-            # Complete token tracking
-            if self._current_request_id:
-                self._token_tracker.complete_request(
-                    self._current_request_id,
-                    txt,
-                    self._current_chat_id
-                )
-        # Clear context cache for this chat as it's now stale
-        cache_keys_to_remove = [
-            k for k in self._context_cache.keys() 
-            if k.startswith(f"{self._current_chat_id}_")
-        ]
-        for key in cache_keys_to_remove:
-            del self._context_cache[key]
+        # The reply is stored, so a history replay may send its next turn
+        self._response_complete.set()
+        # Complete token tracking
+        if self._current_chat_id and self._current_request_id:
+            try:
+                self._token_tracker.complete_request(self._current_request_id, txt)
+            except Exception as e:
+                # Never let tracking break the stream: the caller still has to clear the consumed block
+                print(f"Token tracking error: {e}", flush=True)
+        # The cached context for this chat extends itself from the new reply on the next send
+
+    def _session(self, chat_id: str) -> List[Dict]:
+        """Return a chat's in-memory history, reloading it from storage if it was evicted, and mark it recently used."""
+        with self._sessions_lock:
+            messages = self._chat_sessions.get(chat_id)
+            reload = messages is None and chat_id in self._evicted_sessions
+        # Storage is read without the lock so the reader thread can keep appending replies
+        stored = self._stored_turns(chat_id) if reload else []
+        with self._sessions_lock:
+            messages = self._chat_sessions.get(chat_id)
+            if messages is None:
+                messages = stored if chat_id in self._evicted_sessions else []
+                self._evicted_sessions.discard(chat_id)
+                self._chat_sessions[chat_id] = messages
+            self._chat_sessions.move_to_end(chat_id)
+        self._evict_sessions(chat_id)
+        return messages
+
+    def _append_turn(self, chat_id: str, message: Dict) -> None:
+        """Append a message to a chat's history from the reader thread, without touching storage."""
+        with self._sessions_lock:
+            # An evicted chat gets the reply from storage, where the app saves it, when it is next used
+            if chat_id in self._evicted_sessions:
+                return
+            messages = self._chat_sessions.get(chat_id)
+            if messages is None:
+                messages = self._chat_sessions[chat_id] = []
+            self._chat_sessions.move_to_end(chat_id)
+            messages.append(message)
+
+    def _stored_turns(self, chat_id: str) -> List[Dict]:
+        """Return the user and assistant turns storage holds for a chat."""
+        try:
+            saved = (storage.load_chat(chat_id) or {}).get('messages') or []
+        except Exception:
+            return []
+        return [{"role": m.get("role"), "content": m.get("content") or ""} for m in saved
+                if m.get("role") in ("user", "assistant")]
+
+    def _evict_sessions(self, keep: str) -> None:
+        """Drop least recently used histories beyond the cap, keeping any that storage could not give back."""
+        # Pick candidates under the lock, then check them against storage without it
+        with self._sessions_lock:
+            excess = len(self._chat_sessions) - _SESSION_CACHE_CHATS
+            if excess <= 0:
+                return
+            candidates = [
+                (old_id, len(messages)) for old_id, messages in self._chat_sessions.items()
+                if old_id not in (keep, self._current_chat_id)
+                and self._unsaved_sessions.get(old_id) != len(messages)  # Not already found missing from storage
+            ]
+        saved, unsaved = [], []
+        for old_id, count in candidates:
+            if len(saved) >= excess:
+                break
+            (saved if len(self._stored_turns(old_id)) >= count else unsaved).append((old_id, count))
+        with self._sessions_lock:
+            self._unsaved_sessions.update(unsaved)
+            for old_id, count in saved:
+                messages = self._chat_sessions.get(old_id)
+                # Skip chats that grew or became current while storage was being read
+                if messages is None or len(messages) != count or old_id == self._current_chat_id:
+                    continue
+                if len(self._chat_sessions) <= _SESSION_CACHE_CHATS:
+                    break
+                del self._chat_sessions[old_id]
+                self._unsaved_sessions.pop(old_id, None)
+                self._context_cache.pop(old_id, None)
+                self._evicted_sessions.add(old_id)
 
     def restore_chat_context(self, chat_id: str, messages: List[Dict]) -> None:
         """Restore context for a specific chat session."""
-        if chat_id not in self._chat_sessions:
-            self._chat_sessions[chat_id] = []
-        
-        # Clear existing messages and replace with provided ones
-        self._chat_sessions[chat_id].clear()
-        self._chat_sessions[chat_id].extend(messages)
+        with self._sessions_lock:
+            # The provided history replaces whatever storage holds
+            self._evicted_sessions.discard(chat_id)
+            session = self._chat_sessions.setdefault(chat_id, [])
+            self._chat_sessions.move_to_end(chat_id)
+            
+            # Clear existing messages and replace with provided ones
+            session.clear()
+            session.extend(messages)
+        self._evict_sessions(chat_id)
         # Clear context cache for this chat
-        cache_keys_to_remove = [
-            k for k in self._context_cache.keys() 
-            if k.startswith(f"{chat_id}_")
-        ]
-        for key in cache_keys_to_remove:
-            del self._context_cache[key]
+        self._context_cache.pop(chat_id, None)
 
     def switch_chat(self, new_chat_id: str) -> None:
         """Switch to a different chat session."""
         self._current_chat_id = new_chat_id
         # Initialize session if it doesn't exist
-        if new_chat_id not in self._chat_sessions:
-            self._chat_sessions[new_chat_id] = []
+        self._session(new_chat_id)
 
     def clear_chat_session(self, chat_id: str) -> None:
         """Clear all messages for a specific chat."""
-        if chat_id in self._chat_sessions:
-            self._chat_sessions[chat_id].clear()        
+        with self._sessions_lock:
+            if chat_id in self._chat_sessions:
+                self._chat_sessions[chat_id].clear()
+            self._evicted_sessions.discard(chat_id)
         # Clear context cache
-        cache_keys_to_remove = [
-            k for k in self._context_cache.keys() 
-            if k.startswith(f"{chat_id}_")
-        ]
-        for key in cache_keys_to_remove:
-            del self._context_cache[key]
+        self._context_cache.pop(chat_id, None)
 
     def restart_with_context(self, model: str, messages: List[Dict], 
                          on_raw_output: Optional[Callable] = None,
@@ -811,26 +1153,29 @@ class FoundryCLI:
         """Restart chat session with full conversation history."""
         # Stop existing session
         self.stop_chat()
-        # Start new session  
+        # Start new session; start_chat returns once the model reports ready
         self.start_chat(model, on_raw_output, on_assistant)
-        # Wait a moment for session to initialize
-        time.sleep(0.5)
         # Replay conversation history (all except the last user message)
         for msg in messages[:-1]:
             if msg['role'] == 'user':
+                self._response_complete.clear()
                 self.send_prompt(msg['content'])
-                # Wait for response to complete before next message
-                time.sleep(1.0)
+                # Wait for the reply to complete; replies without end markers wait out the full cap
+                self._response_complete.wait(_REPLAY_TURN_WAIT)
     
     def get_context_usage(self) -> Tuple[int, int]:
         """Return (used_tokens, max_tokens) for current context."""
-        # Estimate based on current chat's token usage
-        if self._current_chat_id:
-            used_tokens = self._token_tracker.get_chat_total_tokens(self._current_chat_id)
-            # Default context window size (can be made configurable)
-            max_tokens = 4096
-            return (used_tokens, max_tokens)
-        return (0, 4096)
+        max_tokens = self._context_mgr.max_tokens
+        messages = self._chat_sessions.get(self._current_chat_id) if self._current_chat_id else None
+        if not messages:
+            return (0, max_tokens)
+        # Reuse the counts already taken by the context builder and only estimate newer turns
+        counted, used_tokens = 0, 0
+        state = self._context_cache.get(self._current_chat_id)
+        if state and state["count"] <= len(messages) and (not state["count"] or messages[state["count"] - 1] is state["last"]):
+            counted, used_tokens = state["count"], state["tokens"]
+        used_tokens += sum(estimate_tokens(msg["content"]) for msg in messages[counted:])
+        return (used_tokens, max_tokens)
     
     def unload_model(self) -> None:
         """Aggressively unload model and release ALL resources."""
@@ -838,7 +1183,7 @@ class FoundryCLI:
         with self._process_cleanup_lock:
             self._model_loaded = False
             # Set stop event first
-            self._stop_event.set()
+            self._wake_reader()
             # Kill process hierarchy (Windows)
             if os.name == 'nt' and self._proc:
                 try:
@@ -878,28 +1223,59 @@ class FoundryCLI:
                 self._reader_thread.join(timeout=3)
                 if self._reader_thread.is_alive():
                     print("Warning: Reader thread did not terminate cleanly", flush=True)
+            # A reader still selecting on the wake pipe keeps it; otherwise both ends are released
+            if not (self._reader_thread and self._reader_thread.is_alive()):
+                self._close_wake_pipe()
             self._reader_thread = None
             # Clear all data structures
-            self._chat_sessions.clear()
+            with self._sessions_lock:
+                self._chat_sessions.clear()
+                self._evicted_sessions.clear()
+                self._unsaved_sessions.clear()
             self._context_cache.clear()
             self._current_chat_id = None
             self._current_request_id = None
-            self._buffer = ""            
+            self._buffer = []
+            self._buffer_len = 0
             # Force Python garbage collection
-            import gc
             gc.collect()
-            # Kill any orphaned Foundry processes
-            self._kill_orphaned_processes()
-            # Wait for GPU memory to be released
-            time.sleep(1.0)
-            # Verify cleanup
-            if self._gpu_monitor:
-                info = self._gpu_monitor.get_gpu_memory_usage()
-                if info:
-                    print(f"GPU memory after cleanup: {info.used_mb}MB", flush=True)
+            # Kill any orphaned Foundry processes and verify cleanup in the background so the caller isn't blocked
+            self._wait_for_cleanup()
+            self._cleanup_thread = threading.Thread(target=self._finish_unload, daemon=True)
+            self._cleanup_thread.start()
+
+    def _finish_unload(self) -> None:
+        """Sweep orphaned processes, then report GPU memory once it has had time to be released."""
+        self._kill_orphaned_processes()
+        if self._gpu_monitor:
+            timer = threading.Timer(1.0, self._report_gpu_after_cleanup)
+            timer.daemon = True
+            timer.start()
+
+    def _report_gpu_after_cleanup(self) -> None:
+        """Verify cleanup by logging GPU memory usage."""
+        try:
+            info = self._gpu_monitor.get_gpu_memory_usage()
+            if info:
+                print(f"GPU memory after cleanup: {info.used_mb}MB", flush=True)
+        except Exception:
+            pass
+
+    def _wait_for_cleanup(self) -> bool:
+        """Wait for a background orphan sweep started by unload_model; return False if it is still running."""
+        thread = self._cleanup_thread
+        if thread and thread.is_alive():
+            thread.join(timeout=_CLEANUP_WAIT)
+            if thread.is_alive():
+                # The sweep kills every foundry process, so nothing may be spawned until it ends
+                print("Warning: model cleanup is still running", flush=True)
+                return False
+        self._cleanup_thread = None
+        return True
 
     def _kill_orphaned_processes(self) -> None:
         """Kill any orphaned Foundry processes not tracked by this instance."""
+        self._last_orphan_scan = time.monotonic()
         try:
             if os.name == 'nt':
                 # Windows: Kill all foundry.exe processes
@@ -955,7 +1331,7 @@ class FoundryCLI:
     def stop_chat(self) -> None:
         """Stop chat session with proper cleanup."""
         with self._process_cleanup_lock:
-            self._stop_event.set()
+            self._wake_reader()
             
             if self._proc and self._proc.poll() is None:
                 try:
@@ -984,9 +1360,11 @@ class FoundryCLI:
             # Don't clear chat sessions on stop - they should persist
             self._model_loaded = False
 
-    def get_chat_sessions(self) -> Dict[str, List[Dict]]:
-        """Get all chat sessions (for testing compatibility)."""
-        return self._chat_sessions
+    def get_chat_sessions(self) -> Mapping[str, List[Dict]]:
+        """Get a read-only snapshot of the in-memory chat sessions (for testing compatibility)."""
+        # The reader thread adds sessions while callers iterate; the copy is at most _SESSION_CACHE_CHATS entries
+        with self._sessions_lock:
+            return types.MappingProxyType(dict(self._chat_sessions))
 
     def get_memory_usage(self) -> int:
         """Get current GPU memory usage in MB."""
@@ -2,11 +2,13 @@
 GPU memory monitoring module for performance optimization.
 
 Monitors GPU memory usage and triggers cleanup when thresholds are exceeded.
-Supports NVIDIA GPUs via nvidia-smi and Windows Management Instrumentation.
+Supports NVIDIA GPUs via NVML (pynvml) or nvidia-smi, and Windows Management
+Instrumentation.
 
 Authors:
     - Benjamin Dourthe (benjamin@adonamed.com)
 """
+import json
 import os
 import re
 import subprocess
@@ -19,6 +21,10 @@ try:
     QT_AVAILABLE = True
 except ImportError:
     QT_AVAILABLE = False
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 
 @dataclass
@@ -50,6 +56,11 @@ class GPUMonitor:
         self._last_trigger_time = 0
         self._trigger_cooldown = 30  # 30 seconds between triggers
         self._last_info: Optional[GPUMemoryInfo] = None
+        self._nvml_handle = None
+        self._nvml_failed = pynvml is None
+        self._nvidia_smi_missing = False
+        self._wmi_probed = False
+        self._wmi_info: Optional[GPUMemoryInfo] = None
         
     def get_gpu_memory_usage(self) -> Optional[GPUMemoryInfo]:
         """Return current GPU memory usage information."""
@@ -65,8 +76,37 @@ class GPUMonitor:
             
         return None
     
+    def _get_nvml_memory(self) -> Optional[GPUMemoryInfo]:
+        """Get memory usage from the first NVIDIA GPU via in-process NVML calls."""
+        if self._nvml_failed:
+            return None
+        try:
+            if self._nvml_handle is None:
+                pynvml.nvmlInit()
+                self._nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            mem = pynvml.nvmlDeviceGetMemoryInfo(self._nvml_handle)
+            util = pynvml.nvmlDeviceGetUtilizationRates(self._nvml_handle)
+            try:
+                temperature = int(pynvml.nvmlDeviceGetTemperature(self._nvml_handle, pynvml.NVML_TEMPERATURE_GPU))
+            except Exception:
+                temperature = None
+            return GPUMemoryInfo(
+                used_mb=int(mem.used) // (1024 * 1024),
+                total_mb=int(mem.total) // (1024 * 1024),
+                utilization_percent=float(util.gpu),
+                temperature_c=temperature
+            )
+        except Exception:
+            # No NVIDIA driver/device: stop trying and use the nvidia-smi path
+            self._nvml_failed = True
+            self._nvml_handle = None
+            return None
+    
     def _get_nvidia_memory(self) -> Optional[GPUMemoryInfo]:
-        """Get memory usage from NVIDIA GPU via nvidia-smi."""
+        """Get memory usage from NVIDIA GPU via NVML, falling back to nvidia-smi."""
+        info = self._get_nvml_memory()
+        if info or self._nvidia_smi_missing:
+            return info
         try:
             flags = getattr(subprocess, 'CREATE_NO_WINDOW', 0) if os.name == 'nt' else 0
             cmd = [
@@ -102,8 +142,11 @@ class GPUMonitor:
                         utilization_percent=utilization,
                         temperature_c=temperature
                     )
+        except FileNotFoundError:
+            # No NVIDIA tools installed; don't spawn a process for it on every poll
+            self._nvidia_smi_missing = True
         except (subprocess.TimeoutExpired, subprocess.CalledProcessError, 
-                FileNotFoundError, ValueError, IndexError):
+                ValueError, IndexError):
             pass
         
         return None
@@ -112,6 +155,9 @@ class GPUMonitor:
         """Get memory usage from GPU via Windows WMI."""
         if os.name != 'nt':
             return None
+        # Adapter RAM is static and usage is a fixed estimate, so PowerShell only needs to run once
+        if self._wmi_probed:
+            return self._wmi_info
             
         try:
             # PowerShell command to get GPU memory info
@@ -127,8 +173,9 @@ class GPUMonitor:
                 '-Command', ps_cmd
             ], capture_output=True, text=True, timeout=10, creationflags=flags)
             
+            if result.returncode == 0:
+                self._wmi_probed = True
             if result.returncode == 0 and result.stdout.strip():
-                import json
                 data = json.loads(result.stdout.strip())
                 
                 if 'AdapterRAM' in data:
@@ -139,13 +186,16 @@ class GPUMonitor:
                     # Estimate based on system memory usage patterns
                     used_mb = int(total_mb * 0.1)  # Conservative estimate
                     
-                    return GPUMemoryInfo(
+                    self._wmi_info = GPUMemoryInfo(
                         used_mb=used_mb,
                         total_mb=total_mb,
                         utilization_percent=10.0  # Conservative estimate
                     )
+                    return self._wmi_info
+        except FileNotFoundError:
+            self._wmi_probed = True
         except (subprocess.TimeoutExpired, subprocess.CalledProcessError, 
-                FileNotFoundError, json.JSONDecodeError, KeyError):
+                json.JSONDecodeError, KeyError, TypeError, ValueError):
             pass
         
         return None
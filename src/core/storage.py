@@ -12,12 +12,19 @@ downloaded models registry under the legacy base path.
 Authors:
     - Benjamin Dourthe (benjamin@adonamed.com)
 """
+import atexit
 import json
 import os
-import re
+import threading
 import uuid
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from bisect import bisect_left
+from operator import itemgetter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+try:
+    import orjson
+except ImportError:  # Optional speedup; the stdlib json module is used otherwise
+    orjson = None
 
 def _base_dir() -> str:
     """Return legacy base dir for models registry (kept unchanged)."""
@@ -34,6 +41,48 @@ def _chat_base_dir() -> str:
 _CHATS_DIR = os.path.join(_chat_base_dir(), 'chat_history')
 _MODELS_FILE = os.path.join(_base_dir(), 'data', 'models.json')
 _SETTINGS_FILE = os.path.join(_chat_base_dir(), 'settings.json')
+# Sidecar copy of _CHAT_META so a fresh process only re-parses chat files that changed since it was written
+_INDEX_FILE = os.path.join(_chat_base_dir(), 'chat_index.json')
+# Chat id -> file path, recorded whenever a chat file is read or written so lookups skip the directory scan
+_CHAT_PATHS: Dict[str, str] = {}
+# Chat file path -> ((mtime_ns, size), (id, title, created_at, updated_at, sort key)); list_chats re-parses only changed files
+_CHAT_META: Dict[str, Tuple[Tuple[int, int], Tuple]] = {}
+# Chat file path -> ((mtime_ns, size), fields other than messages, message count) for files this process wrote
+_CHAT_HEADERS: Dict[str, Tuple[Tuple[int, int], Dict, int]] = {}
+_INDEX_LOADED = False
+_INDEX_DIRTY = False  # _CHAT_META changed since the index was last written
+# Saves arriving within this many seconds of each other are written once
+_SAVE_DELAY = 0.3
+# Chat id -> (latest messages, timer that writes them); guarded by _SAVE_LOCK, which is also held while writing
+_PENDING_SAVES: Dict[str, Tuple[List[Dict], threading.Timer]] = {}
+_SAVE_LOCK = threading.RLock()
+# models.json (mtime_ns, size) and the sorted, de-duplicated names it holds; reads skip parsing while it is unchanged
+_MODELS_CACHE: Optional[Tuple[Tuple[int, int], List[str]]] = None
+# Characters Windows forbids in file names, each mapped to '_'
+_BAD_NAME_CHARS = str.maketrans({c: '_' for c in '\\/:*?"<>|'})
+
+def _read_json(path: str) -> Any:
+    """Parse a UTF-8 JSON file."""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json(path: str, data: Any, fsync: bool = True) -> None:
+    """Write data as 2-space indented UTF-8 JSON, replacing the file atomically (fsync makes it durable too)."""
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    # A crash mid-write leaves only the temp file behind, never a truncated chat
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 def _ensure_dirs() -> None:
     """Create chat and models directories if absent."""
@@ -44,8 +93,7 @@ def _ensure_dirs() -> None:
 def _slug(title: str) -> str:
     """Sanitize a title for safe filesystem use on all platforms."""
     t = (title or 'Untitled').strip()
-    t = re.sub(r"[\\/:*?\"<>|]", "_", t)
-    t = re.sub(r"\s+", " ", t)
+    t = ' '.join(t.translate(_BAD_NAME_CHARS).split())
     t = t.strip(" .")
     if not t:
         t = 'Untitled'
@@ -64,25 +112,52 @@ def _build_filename(title: str, created_iso: Optional[str]) -> str:
     date_str = _date_from_iso(created_iso)
     return f"{date_str}_{_slug(title)}.json"
 
-def _find_chat_path_by_id(chat_id: str) -> Optional[str]:
-    """Scan chat history to find the file path for a given chat id."""
+def _find_chat_entry(chat_id: str) -> Optional[Tuple[str, Optional[Dict]]]:
+    """Return (path, data) for a chat id; data is the parsed file when a scan had to read it, else None."""
+    global _INDEX_DIRTY
     _ensure_dirs()
+    known = _CHAT_PATHS.get(chat_id)
+    if known and os.path.exists(known):
+        return known, None
+    # The index may already name the file; trust it only while the file is unchanged
+    _load_index()
+    for p, (sig, fields) in list(_CHAT_META.items()):
+        if fields[0] != chat_id:
+            continue
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        if (st.st_mtime_ns, st.st_size) == sig:
+            _CHAT_PATHS[chat_id] = p
+            return p, None
     try:
-        for name in os.listdir(_CHATS_DIR):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(_CHATS_DIR, name)
-            try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    d = json.load(f)
-                if d.get('id') == chat_id:
-                    return p
-            except Exception:
-                continue
+        with os.scandir(_CHATS_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                p = entry.path
+                try:
+                    st = entry.stat()
+                    d = _read_json(p)
+                    if d.get('id'):
+                        _CHAT_PATHS[d['id']] = p
+                    # Keep what was parsed so the next listing need not read the file again
+                    _CHAT_META[p] = ((st.st_mtime_ns, st.st_size), _meta_fields(d))
+                    _INDEX_DIRTY = True
+                    if d.get('id') == chat_id:
+                        return p, d
+                except Exception:
+                    continue
     except Exception:
         pass
     return None
 
+def _find_chat_path_by_id(chat_id: str) -> Optional[str]:
+    """Return the file path for a chat id, scanning chat history only if it is not already known."""
+    entry = _find_chat_entry(chat_id)
+    return entry[0] if entry else None
+
 def _unique_path_for(filename: str) -> str:
     """Ensure the returned path is unique by adding a numeric suffix if needed."""
     base, ext = os.path.splitext(filename)
@@ -96,6 +171,80 @@ def _unique_path_for(filename: str) -> str:
             return cand
         i += 1
 
+def _sort_key(stamp: Optional[str]) -> float:
+    """Return epoch seconds for an ISO timestamp (naive values are UTC); missing sorts newest, invalid oldest."""
+    if not stamp:
+        return float('inf')
+    try:
+        dt = datetime.fromisoformat(stamp)
+    except (TypeError, ValueError):
+        return 0.0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def _meta_fields(data: Dict) -> Tuple:
+    """Return the (id, title, created_at, updated_at, sort key) list_chats needs from chat data."""
+    created_at, updated_at = data.get('created_at'), data.get('updated_at')
+    return (data.get('id'), data.get('title'), created_at, updated_at, _sort_key(updated_at or created_at))
+
+def _load_index() -> None:
+    """Seed _CHAT_META from the sidecar index once per process; entries still have to match the file on disk."""
+    global _INDEX_LOADED
+    if _INDEX_LOADED:
+        return
+    _INDEX_LOADED = True
+    try:
+        chats = _read_json(_INDEX_FILE).get('chats') or {}
+        for name, (mtime_ns, size, chat_id, title, created_at, updated_at) in chats.items():
+            path = os.path.join(_CHATS_DIR, name)
+            if path not in _CHAT_META:
+                fields = (chat_id, title, created_at, updated_at, _sort_key(updated_at or created_at))
+                _CHAT_META[path] = ((mtime_ns, size), fields)
+    except Exception:
+        pass
+
+def _save_index() -> None:
+    """Write _CHAT_META to the sidecar index if it changed (also run at interpreter exit)."""
+    global _INDEX_DIRTY
+    if not _INDEX_DIRTY:
+        return
+    _INDEX_DIRTY = False
+    try:
+        chats = {os.path.basename(p): [sig[0], sig[1], *fields[:4]] for p, (sig, fields) in list(_CHAT_META.items())}
+        # Only a cache: losing it to a crash costs one re-parse, so skip the fsync
+        _write_json(_INDEX_FILE, {'version': 1, 'chats': chats}, fsync=False)
+    except Exception:
+        pass
+
+def _remember_chat(path: str, data: Dict) -> None:
+    """Record the metadata of a chat file just written so list_chats need not parse it again."""
+    global _INDEX_DIRTY
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    sig = (st.st_mtime_ns, st.st_size)
+    _CHAT_META[path] = (sig, _meta_fields(data))
+    _INDEX_DIRTY = True
+    # 'messages' keeps its key position so rewrites produce the same layout
+    header = {k: (None if k == 'messages' else v) for k, v in data.items()}
+    _CHAT_HEADERS[path] = (sig, header, len(data.get('messages') or []))
+    if data.get('id'):
+        _CHAT_PATHS[data['id']] = path
+
+def _chat_fields(path: str, st: os.stat_result) -> Tuple:
+    """Return (id, title, created_at, updated_at, sort key) of a chat file, parsing it only if it changed."""
+    global _INDEX_DIRTY
+    sig = (st.st_mtime_ns, st.st_size)
+    hit = _CHAT_META.get(path)
+    if hit and hit[0] == sig:
+        return hit[1]
+    fields = _meta_fields(_read_json(path))
+    _CHAT_META[path] = (sig, fields)
+    _INDEX_DIRTY = True
+    return fields
+
 def _chat_path(chat_id: str) -> Optional[str]:
     """Return file path for a chat id by scanning files (may be None)."""
     return _find_chat_path_by_id(chat_id)
@@ -107,29 +256,43 @@ def list_chats() -> List[Dict]:
     Returns:
         - list[dict]: [{id,title,created_at,updated_at}]
     """
+    global _INDEX_DIRTY
     _ensure_dirs()
-    items: List[Tuple[str, Dict]] = []
+    flush_pending_writes()
+    _load_index()
+    items: List[Tuple[float, Dict]] = []
+    seen = set()
+    now: Optional[str] = None  # Fallback stamp for chats missing one, taken once per listing
     try:
-        for name in os.listdir(_CHATS_DIR):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(_CHATS_DIR, name)
-            try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            except Exception:
-                continue
-            chat_id = data.get('id') or uuid.uuid4().hex
-            meta = {
-                'id': chat_id,
-                'title': data.get('title') or 'Untitled',
-                'created_at': data.get('created_at') or datetime.utcnow().isoformat(),
-                'updated_at': data.get('updated_at') or data.get('created_at') or datetime.utcnow().isoformat(),
-            }
-            items.append((meta['updated_at'], meta))
+        with os.scandir(_CHATS_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                p = entry.path
+                seen.add(p)
+                try:
+                    stored_id, title, created_at, updated_at, sort_key = _chat_fields(p, entry.stat())
+                except Exception:
+                    continue
+                chat_id = stored_id or uuid.uuid4().hex
+                if stored_id:
+                    _CHAT_PATHS[chat_id] = p
+                if not created_at and now is None:
+                    now = datetime.utcnow().isoformat()
+                meta = {
+                    'id': chat_id,
+                    'title': title or 'Untitled',
+                    'created_at': created_at or now,
+                    'updated_at': updated_at or created_at or now,
+                }
+                items.append((sort_key, meta))
     except Exception:
         pass
-    items.sort(key=lambda t: t[0], reverse=True)
+    for stale in _CHAT_META.keys() - seen:
+        del _CHAT_META[stale]
+        _INDEX_DIRTY = True
+    _save_index()
+    items.sort(key=itemgetter(0), reverse=True)
     return [m for _, m in items]
 
 def create_chat(title: str) -> str:
@@ -144,61 +307,116 @@ def create_chat(title: str) -> str:
     Returns:
         - str: Chat id
     """
-    _ensure_dirs()
-    chat_id = uuid.uuid4().hex
-    now = datetime.utcnow().isoformat()
-    data = {'id': chat_id, 'title': title or 'New Chat', 'messages': [], 'created_at': now, 'updated_at': now}
-    fname = _build_filename(data['title'], data['created_at'])
-    path = _unique_path_for(fname)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    return chat_id
+    # Held so the debounce timer never updates the index or chat maps at the same time
+    with _SAVE_LOCK:
+        _ensure_dirs()
+        chat_id = uuid.uuid4().hex
+        now = datetime.utcnow().isoformat()
+        data = {'id': chat_id, 'title': title or 'New Chat', 'messages': [], 'created_at': now, 'updated_at': now}
+        fname = _build_filename(data['title'], data['created_at'])
+        path = _unique_path_for(fname)
+        _write_json(path, data)
+        _remember_chat(path, data)
+        return chat_id
 
 def rename_chat(chat_id: str, title: str) -> None:
     """Rename an existing chat and its file to match the new title."""
-    path = _find_chat_path_by_id(chat_id)
-    if not path or not os.path.exists(path):
-        return
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        data['title'] = title or data.get('title') or 'Untitled'
-        data['updated_at'] = datetime.utcnow().isoformat()
-        # Write changes first
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        # Compute new filename based on created_at and new title
-        target_name = _build_filename(data.get('title') or 'Untitled', data.get('created_at'))
-        target_path = os.path.join(_CHATS_DIR, target_name)
-        if os.path.normcase(os.path.abspath(path)) != os.path.normcase(os.path.abspath(target_path)):
-            target_path = _unique_path_for(target_name)
-            try:
-                os.replace(path, target_path)
-            except Exception:
-                pass
-    except Exception:
-        pass
+    # Held across the write and the file move so a pending save cannot land on the old path
+    with _SAVE_LOCK:
+        _flush_save(chat_id)
+        entry = _find_chat_entry(chat_id)
+        if not entry or not os.path.exists(entry[0]):
+            return
+        path, data = entry
+        try:
+            if data is None:
+                data = _read_json(path)
+            data['title'] = title or data.get('title') or 'Untitled'
+            data['updated_at'] = datetime.utcnow().isoformat()
+            # Write changes first
+            _write_json(path, data)
+            # Compute new filename based on created_at and new title
+            target_name = _build_filename(data.get('title') or 'Untitled', data.get('created_at'))
+            target_path = os.path.join(_CHATS_DIR, target_name)
+            if os.path.normcase(os.path.abspath(path)) != os.path.normcase(os.path.abspath(target_path)):
+                target_path = _unique_path_for(target_name)
+                try:
+                    os.replace(path, target_path)
+                    _CHAT_META.pop(path, None)
+                    _CHAT_HEADERS.pop(path, None)
+                    path = target_path
+                except Exception:
+                    pass
+            _remember_chat(path, data)
+        except Exception:
+            pass
 
 def load_chat(chat_id: str) -> Optional[Dict]:
     """Load chat data by id."""
-    path = _find_chat_path_by_id(chat_id)
-    if not path or not os.path.exists(path):
+    _flush_save(chat_id)
+    entry = _find_chat_entry(chat_id)
+    if not entry or not os.path.exists(entry[0]):
         return None
+    path, data = entry
+    if data is not None:
+        return data
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json(path)
     except Exception:
         return None
 
-def save_messages(chat_id: str, messages: List[Dict]) -> None:
-    """Persist messages array to a chat, update timestamps, and adjust filename."""
-    path = _find_chat_path_by_id(chat_id)
-    if not path or not os.path.exists(path):
+def save_messages(chat_id: str, messages: List[Dict], sync: bool = False) -> None:
+    """Persist messages array to a chat; rapid successive saves are coalesced into one write unless sync is set."""
+    with _SAVE_LOCK:
+        pending = _PENDING_SAVES.pop(chat_id, None)
+        if pending:
+            pending[1].cancel()
+        if sync:
+            # Written and fsynced before returning, replacing any save still waiting on its timer
+            _write_messages(chat_id, list(messages), durable=True)
+            return
+        timer = threading.Timer(_SAVE_DELAY, _flush_save, args=(chat_id,))
+        timer.daemon = True
+        _PENDING_SAVES[chat_id] = (list(messages), timer)
+        timer.start()
+
+def _flush_save(chat_id: str) -> None:
+    """Write the pending messages of a chat, if any."""
+    with _SAVE_LOCK:
+        pending = _PENDING_SAVES.pop(chat_id, None)
+        if pending:
+            pending[1].cancel()
+            _write_messages(chat_id, pending[0])
+
+def flush_pending_writes() -> None:
+    """Write every pending chat save now (also run at interpreter exit)."""
+    with _SAVE_LOCK:
+        for chat_id in list(_PENDING_SAVES):
+            _flush_save(chat_id)
+
+# atexit runs handlers last-registered first, so pending saves are written before the index
+atexit.register(_save_index)
+atexit.register(flush_pending_writes)
+
+def _write_messages(chat_id: str, messages: List[Dict], durable: bool = False) -> None:
+    """Persist messages array to a chat, update timestamps, and adjust filename (fsynced if durable)."""
+    entry = _find_chat_entry(chat_id)
+    if not entry or not os.path.exists(entry[0]):
         return
+    path, data = entry
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        was_empty = len(data.get('messages') or []) == 0
+        st = os.stat(path)
+        hit = _CHAT_HEADERS.get(path)
+        if hit and hit[0] == (st.st_mtime_ns, st.st_size):
+            # Unchanged since this process wrote it: reuse its fields rather than parsing the old messages
+            data, was_empty = dict(hit[1]), hit[2] == 0
+        elif data is not None:
+            # Just parsed by the lookup scan
+            was_empty = len(data.get('messages') or []) == 0
+        else:
+            data = _read_json(path)
+            was_empty = len(data.get('messages') or []) == 0
+        now = datetime.utcnow().isoformat()
         data['messages'] = messages
         # If first user message arrives now, set created_at to its date
         if was_empty and messages:
@@ -208,13 +426,12 @@ def save_messages(chat_id: str, messages: List[Dict]) -> None:
                     if m.get('role') == 'user':
                         first_user_ts = m.get('ts')
                         break
-                data['created_at'] = first_user_ts or data.get('created_at') or datetime.utcnow().isoformat()
+                data['created_at'] = first_user_ts or data.get('created_at') or now
             except Exception:
-                data['created_at'] = data.get('created_at') or datetime.utcnow().isoformat()
-        data['updated_at'] = datetime.utcnow().isoformat()
-        # Write content first
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+                data['created_at'] = data.get('created_at') or now
+        data['updated_at'] = now
+        # Write content first; debounced saves leave flushing to the OS, the replace keeps them whole either way
+        _write_json(path, data, fsync=durable)
         # If created_at just got set (or title changed previously), ensure filename matches policy
         desired_name = _build_filename(data.get('title') or 'Untitled', data.get('created_at'))
         desired_path = os.path.join(_CHATS_DIR, desired_name)
@@ -222,14 +439,28 @@ def save_messages(chat_id: str, messages: List[Dict]) -> None:
             desired_path = _unique_path_for(desired_name)
             try:
                 os.replace(path, desired_path)
+                _CHAT_META.pop(path, None)
+                _CHAT_HEADERS.pop(path, None)
+                path = desired_path
             except Exception:
                 pass
+        _remember_chat(path, data)
     except Exception:
         pass
 
 def delete_chat(chat_id: str) -> None:
     """Delete chat file by id."""
+    global _INDEX_DIRTY
+    with _SAVE_LOCK:
+        pending = _PENDING_SAVES.pop(chat_id, None)
+        if pending:
+            pending[1].cancel()
     path = _find_chat_path_by_id(chat_id)
+    _CHAT_PATHS.pop(chat_id, None)
+    if path:
+        if _CHAT_META.pop(path, None):
+            _INDEX_DIRTY = True
+        _CHAT_HEADERS.pop(path, None)
     try:
         if path and os.path.exists(path):
             os.remove(path)
@@ -244,44 +475,71 @@ def _read_models() -> Dict:
     if not os.path.exists(_MODELS_FILE):
         return {'downloaded': []}
     try:
-        with open(_MODELS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if isinstance(data, dict) and 'downloaded' in data and isinstance(data['downloaded'], list):
-                return data
-            return {'downloaded': []}
+        data = _read_json(_MODELS_FILE)
+        if isinstance(data, dict) and 'downloaded' in data and isinstance(data['downloaded'], list):
+            return data
+        return {'downloaded': []}
     except Exception:
         return {'downloaded': []}
 
 def _write_models(data: Dict) -> None:
     """Write models.json safely."""
+    _store_downloaded(sorted(set(data.get('downloaded', []))))
+
+def _store_downloaded(names: List[str]) -> None:
+    """Write an already sorted, de-duplicated registry and remember it as the cached copy."""
+    global _MODELS_CACHE
     _ensure_dirs()
-    with open(_MODELS_FILE, 'w', encoding='utf-8') as f:
-        json.dump({'downloaded': sorted(set(data.get('downloaded', [])))}, f, ensure_ascii=False, indent=2)
+    _write_json(_MODELS_FILE, {'downloaded': names})
+    try:
+        st = os.stat(_MODELS_FILE)
+        _MODELS_CACHE = ((st.st_mtime_ns, st.st_size), names)
+    except OSError:
+        _MODELS_CACHE = None
+
+def _downloaded_names() -> List[str]:
+    """Return the sorted registry names, parsing models.json only when it changed on disk."""
+    global _MODELS_CACHE
+    _ensure_dirs()
+    try:
+        st = os.stat(_MODELS_FILE)
+    except OSError:
+        return []
+    sig = (st.st_mtime_ns, st.st_size)
+    if _MODELS_CACHE is None or _MODELS_CACHE[0] != sig:
+        _MODELS_CACHE = (sig, sorted(set(_read_models().get('downloaded', []))))
+    return _MODELS_CACHE[1]
 
 def get_downloaded_models() -> List[str]:
     """Return list of downloaded models tracked locally."""
-    return sorted(set(_read_models().get('downloaded', [])))
+    return list(_downloaded_names())
 
 def add_downloaded_model(name: str) -> None:
     """Add a model to the downloaded registry."""
-    data = _read_models()
-    d = set(data.get('downloaded', []))
-    d.add(name)
-    data['downloaded'] = sorted(d)
-    _write_models(data)
+    names = _downloaded_names()
+    i = bisect_left(names, name)
+    if i < len(names) and names[i] == name:
+        return
+    _store_downloaded(names[:i] + [name] + names[i:])
+
+def add_downloaded_models(names: Iterable[str]) -> None:
+    """Add several models to the downloaded registry with a single write."""
+    current = _downloaded_names()
+    known = set(current)
+    missing = {n for n in names if n not in known}
+    if missing:
+        _store_downloaded(sorted(known | missing))
 
 def remove_downloaded_model(name: str) -> None:
     """Remove a model from the downloaded registry."""
-    data = _read_models()
-    d = set(data.get('downloaded', []))
-    if name in d:
-        d.remove(name)
-    data['downloaded'] = sorted(d)
-    _write_models(data)
+    names = _downloaded_names()
+    i = bisect_left(names, name)
+    if i < len(names) and names[i] == name:
+        _store_downloaded(names[:i] + names[i + 1:])
 
 def set_downloaded_models(names: List[str]) -> None:
     """Replace the downloaded registry with provided names."""
-    _write_models({'downloaded': list(sorted(set(names)))})
+    _write_models({'downloaded': names})
 
 def migrate_downloaded_aliases(pairs: List[Tuple[str, str]]) -> None:
     """Add model IDs for any legacy alias names in the downloaded registry.
@@ -291,16 +549,9 @@ def migrate_downloaded_aliases(pairs: List[Tuple[str, str]]) -> None:
     """
     if not pairs:
         return
-    data = _read_models()
-    d = set(data.get('downloaded', []))
-    alias_to_id = {a: mid for a, mid in pairs}
-    changed = False
-    for name in list(d):
-        if name in alias_to_id and alias_to_id[name] not in d:
-            d.add(alias_to_id[name])
-            changed = True
-    if changed:
-        _write_models({'downloaded': sorted(d)})
+    # Walk the pairs rather than the registry; dict() keeps the last model id listed for an alias
+    registered = set(_downloaded_names())
+    add_downloaded_models([mid for alias, mid in dict(pairs).items() if alias in registered])
 
 # ---- App settings (generic key/value persisted in settings.json) ----
 
@@ -337,10 +588,9 @@ def _read_settings() -> Dict:
     base = dict(_default_settings())
     try:
         if os.path.exists(_SETTINGS_FILE):
-            with open(_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f) or {}
-                if isinstance(data, dict):
-                    base.update(data)
+            data = _read_json(_SETTINGS_FILE) or {}
+            if isinstance(data, dict):
+                base.update(data)
     except Exception:
         pass
     return base
@@ -354,8 +604,7 @@ def _write_settings(data: Dict) -> None:
             merged.update(data)
     except Exception:
         pass
-    with open(_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(merged, f, ensure_ascii=False, indent=2)
+    _write_json(_SETTINGS_FILE, merged)
 
 def get_app_settings() -> Dict:
     """Return a copy of the current application settings dict."""
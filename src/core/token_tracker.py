@@ -9,10 +9,26 @@ Authors:
 """
 import re
 import threading
-from typing import Dict, List, Optional, Callable, Any
+from collections import deque
+from typing import Deque, Dict, List, Optional, Callable, Any
 from dataclasses import dataclass
 from .tokens import estimate_tokens
 
+# Exchanges kept per chat; totals cover the same window
+_MAX_CHAT_METRICS = 500
+
+# Cheap screen run on the raw line, so only lines mentioning tokens get lowercased
+_TOKEN_WORD = re.compile("token", re.IGNORECASE)
+
+# Token count patterns from local inference engines, matched against the lowercased line in this order
+_TOKEN_LINE_PATTERNS = tuple(re.compile(p) for p in (
+    r"input.*?(\d+).*?tokens?",
+    r"output.*?(\d+).*?tokens?",
+    r"reasoning.*?(\d+).*?tokens?",
+    r"generated.*?(\d+).*?tokens?",
+    r"processed.*?(\d+).*?tokens?",
+    r"total.*?(\d+).*?tokens?",
+))
 
 @dataclass
 class TokenMetrics:
@@ -38,7 +54,9 @@ class TokenTracker:
     
     def __init__(self):
         """Initialize token tracker without side effects."""
-        self._chat_tokens: Dict[str, List[TokenMetrics]] = {}
+        self._chat_tokens: Dict[str, Deque[TokenMetrics]] = {}
+        self._chat_totals: Dict[str, int] = {}  # Sum of total_tokens over each chat's kept exchanges
+        self._recent_context: Dict[str, int] = {}  # Input + output tokens of each chat's last 10 exchanges
         self._pending_requests: Dict[str, Dict[str, Any]] = {}
         self._lock = threading.Lock()
         self._callbacks: List[Callable[[str, TokenMetrics], None]] = []
@@ -93,37 +111,36 @@ class TokenTracker:
         if request_id not in self._pending_requests:
             return
             
-        # Look for token patterns in foundry CLI output
-        # Common patterns from local inference engines:
-        patterns = [
-            r"input.*?(\d+).*?tokens?",
-            r"output.*?(\d+).*?tokens?", 
-            r"reasoning.*?(\d+).*?tokens?",
-            r"generated.*?(\d+).*?tokens?",
-            r"processed.*?(\d+).*?tokens?",
-            r"total.*?(\d+).*?tokens?",
-        ]
+        # Every pattern ends in "token(s)"; most streamed lines have no such word and stop here
+        if not _TOKEN_WORD.search(raw_line):
+            return
         
+        # Look for token patterns in foundry CLI output
         line_lower = raw_line.lower()
         
+        # The field written depends only on the line, so the last pattern that matches decides the count
+        for pattern in reversed(_TOKEN_LINE_PATTERNS):
+            match = pattern.search(line_lower)
+            if match:
+                token_count = int(match.group(1))
+                break
+        else:
+            return
+        if "input" in line_lower or "processed" in line_lower:
+            field = 'actual_input_tokens'
+        elif "output" in line_lower or "generated" in line_lower:
+            field = 'output_tokens'
+        elif "reasoning" in line_lower:
+            field = 'reasoning_tokens'
+        else:
+            field = 'total_tokens'
+        
         with self._lock:
             req = self._pending_requests.get(request_id)
             if not req:
                 return
-                
             # Extract token counts from CLI output if present
-            for pattern in patterns:
-                match = re.search(pattern, line_lower)
-                if match:
-                    token_count = int(match.group(1))
-                    if "input" in line_lower or "processed" in line_lower:
-                        req['actual_input_tokens'] = token_count
-                    elif "output" in line_lower or "generated" in line_lower:
-                        req['output_tokens'] = token_count
-                    elif "reasoning" in line_lower:
-                        req['reasoning_tokens'] = token_count
-                    elif "total" in line_lower:
-                        req['total_tokens'] = token_count
+            req[field] = token_count
     
     def complete_request(self, request_id: str, assistant_output: str) -> Optional[TokenMetrics]:
         """
@@ -138,55 +155,68 @@ class TokenTracker:
         """
         with self._lock:
             req = self._pending_requests.pop(request_id, None)
-            if not req:
-                return None
-                
-            chat_id = req['chat_id']
-            
-            # Use actual token counts if available, otherwise estimate
-            input_tokens = req.get('actual_input_tokens', req['input_tokens'])
-            output_tokens = req.get('output_tokens', self._estimate_output_tokens(assistant_output))
-            reasoning_tokens = req.get('reasoning_tokens', self._estimate_reasoning_tokens(assistant_output))
-            total_tokens = req.get('total_tokens', input_tokens + output_tokens + reasoning_tokens)
-            
-            metrics = TokenMetrics(
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-                reasoning_tokens=reasoning_tokens,
-                total_tokens=total_tokens,
-                model_name=req.get('model_name')
-            )
+        if not req:
+            return None
             
+        chat_id = req['chat_id']
+        
+        # Use actual token counts if available, otherwise estimate (outside the lock, the text may be long)
+        input_tokens = req.get('actual_input_tokens', req['input_tokens'])
+        output_tokens = req.get('output_tokens', self._estimate_output_tokens(assistant_output))
+        reasoning_tokens = req.get('reasoning_tokens', self._estimate_reasoning_tokens(assistant_output))
+        total_tokens = req.get('total_tokens', input_tokens + output_tokens + reasoning_tokens)
+        
+        metrics = TokenMetrics(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            reasoning_tokens=reasoning_tokens,
+            total_tokens=total_tokens,
+            model_name=req.get('model_name')
+        )
+        
+        with self._lock:
             # Store metrics for this chat
             if chat_id not in self._chat_tokens:
-                self._chat_tokens[chat_id] = []
-            self._chat_tokens[chat_id].append(metrics)
+                self._chat_tokens[chat_id] = deque()
+            history = self._chat_tokens[chat_id]
+            total = self._chat_totals.get(chat_id, 0) + metrics.total_tokens
+            if len(history) >= _MAX_CHAT_METRICS:
+                total -= history.popleft().total_tokens
+            history.append(metrics)
+            self._chat_totals[chat_id] = total
+            # Slide the last-10 window used for context estimates
+            recent = self._recent_context.get(chat_id, 0) + metrics.input_tokens + metrics.output_tokens
+            if len(history) > 10:
+                dropped = history[-11]
+                recent -= dropped.input_tokens + dropped.output_tokens
+            self._recent_context[chat_id] = recent
+            callbacks = list(self._callbacks)
             
-            # Notify callbacks
-            for callback in self._callbacks:
-                try:
-                    callback(chat_id, metrics)
-                except Exception:
-                    pass
-                    
-            return metrics
+        # Notify callbacks without the lock so a slow one does not stall other threads
+        for callback in callbacks:
+            try:
+                callback(chat_id, metrics)
+            except Exception:
+                pass
+                
+        return metrics
     
     def get_chat_total_tokens(self, chat_id: str) -> int:
         """Return total tokens used in a chat session."""
         with self._lock:
-            if chat_id not in self._chat_tokens:
-                return 0
-            return sum(m.total_tokens for m in self._chat_tokens[chat_id])
+            return self._chat_totals.get(chat_id, 0)
     
     def get_chat_metrics(self, chat_id: str) -> List[TokenMetrics]:
         """Return all token metrics for a chat session."""
         with self._lock:
-            return self._chat_tokens.get(chat_id, []).copy()
+            return list(self._chat_tokens.get(chat_id, ()))
     
     def clear_chat(self, chat_id: str) -> None:
         """Clear token tracking data for a specific chat."""
         with self._lock:
             self._chat_tokens.pop(chat_id, None)
+            self._chat_totals.pop(chat_id, None)
+            self._recent_context.pop(chat_id, None)
             # Remove any pending requests for this chat
             to_remove = [rid for rid, req in self._pending_requests.items() 
                         if req.get('chat_id') == chat_id]
@@ -197,13 +227,14 @@ class TokenTracker:
         """Clear all token tracking data."""
         with self._lock:
             self._chat_tokens.clear()
+            self._chat_totals.clear()
+            self._recent_context.clear()
             self._pending_requests.clear()
     
     def get_all_chat_tokens(self) -> Dict[str, int]:
         """Return total tokens for all tracked chats."""
         with self._lock:
-            return {cid: sum(m.total_tokens for m in metrics) 
-                   for cid, metrics in self._chat_tokens.items()}
+            return dict(self._chat_totals)
     
     def check_context_limit(self, chat_id: str, new_message: str, 
                             max_tokens: int = 4096) -> bool:
@@ -243,10 +274,11 @@ class TokenTracker:
     def get_context_usage_stats(self, chat_id: str, max_tokens: int = 4096) -> Dict[str, Any]:
         """Get detailed context usage statistics for a chat."""
         with self._lock:
-            total_tokens = self.get_chat_total_tokens(chat_id)
+            # Read the total directly: get_chat_total_tokens would re-acquire the non-reentrant lock
+            total_tokens = self._chat_totals.get(chat_id, 0)
             usage_percent = (total_tokens / max_tokens) * 100.0
             
-            metrics_list = self._chat_tokens.get(chat_id, [])
+            metrics_list = list(self._chat_tokens.get(chat_id, ()))
             
             stats = {
                 'total_tokens': total_tokens,
@@ -291,10 +323,8 @@ class TokenTracker:
         # Add tokens for conversation history
         context_tokens = 0
         with self._lock:
-            if chat_id in self._chat_tokens:
-                # Approximate context from previous messages
-                context_tokens = min(2048, sum(m.input_tokens + m.output_tokens 
-                                             for m in self._chat_tokens[chat_id][-10:]))  # Last 10 exchanges
+            # Approximate context from previous messages: the last 10 exchanges, kept as a running total
+            context_tokens = min(2048, self._recent_context.get(chat_id, 0))
         
         return base_tokens + system_overhead + int(context_tokens * 0.1)  # 10% of context carried forward
     
@@ -6,9 +6,15 @@ Authors:
 """
 import math
 import re
+from functools import lru_cache
 from typing import Dict, List
 
-_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+# Kana, CJK ideographs and Hangul syllables: tokenizers split these roughly one per character,
+# so they are counted individually instead of as a single \w+ run
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+|[^\w\s]", re.UNICODE)
+# Texts this long are estimated directly so the cache never pins large pastes in memory
+_CACHE_MAX_CHARS = 64 * 1024
 
 
 def estimate_tokens(text: str) -> int:
@@ -18,12 +24,24 @@ def estimate_tokens(text: str) -> int:
     s = text.strip()
     if not s:
         return 0
-    units = _TOKEN_PATTERN.findall(s)
-    by_regex = len(units)
+    # subn only counts the matches; findall would build a string per unit just to measure the list
+    by_regex = _TOKEN_PATTERN.subn('', s)[1]
     by_chars = math.ceil(len(s) / 4)
     return max(by_regex, by_chars)
 
 
+@lru_cache(maxsize=4096)
+def _estimate_lru(text: str) -> int:
+    return estimate_tokens(text)
+
+
+def estimate_tokens_cached(text: str) -> int:
+    """Return estimate_tokens(text), cached so unchanged history messages are tokenized once."""
+    if len(text) >= _CACHE_MAX_CHARS:
+        return estimate_tokens(text)
+    return _estimate_lru(text)
+
+
 def estimate_messages_tokens(messages: List[Dict]) -> int:
     """Return approximate total tokens for a list of chat messages.
 
@@ -42,7 +60,7 @@ def estimate_messages_tokens(messages: List[Dict]) -> int:
     overhead = 4
     for m in messages:
         try:
-            total += estimate_tokens(str(m.get('content', '') or '')) + overhead
+            total += estimate_tokens_cached(str(m.get('content', '') or '')) + overhead
         except Exception:
             total += overhead
     return int(total)
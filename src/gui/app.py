@@ -593,6 +593,11 @@ class MainWindow(QMainWindow):
             self._cli.stop_chat()
         except Exception:
             pass
+        # Write saves still waiting on their debounce timer before the window goes away
+        try:
+            storage.flush_pending_writes()
+        except Exception:
+            pass
         return super().closeEvent(e)
     def _fmt_ts(self, iso: Optional[str] = None) -> str:
         """Format timestamp to 'Jan. 1, 2025 - 01:50:45 AM'."""
@@ -698,7 +703,7 @@ class MainWindow(QMainWindow):
                 prev_data = storage.load_chat(prev_cid) or {}
                 msgs = list(prev_data.get('messages', []))
                 msgs.append({'role':'assistant','content':s,'ts':iso})
-                storage.save_messages(prev_cid, msgs)
+                storage.save_messages(prev_cid, msgs, sync=True)
             except Exception:
                 pass
             self._typing = None
@@ -2264,7 +2269,7 @@ class MainWindow(QMainWindow):
         except Exception:
             pass
         self._messages.append({'role':'user','content':txt,'ts':now_iso})
-        storage.save_messages(origin_cid, self._messages)
+        storage.save_messages(origin_cid, self._messages, sync=True)
         try:
             self._update_token_warning()
         except Exception:
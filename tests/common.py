@@ -479,6 +479,19 @@ def _setup_mock_environment() -> Tuple[MockFoundryCLI, MockStorage]:
     
     return foundry_cli, storage
 
+def isolated_storage(root: str):
+    """Return a patcher pointing storage at an empty tree under root, with empty in-memory caches."""
+    from core import storage
+    return patch.multiple(
+        storage,
+        _CHATS_DIR=os.path.join(root, 'chat_history'),
+        _MODELS_FILE=os.path.join(root, 'models.json'),
+        _SETTINGS_FILE=os.path.join(root, 'settings.json'),
+        _INDEX_FILE=os.path.join(root, 'chat_index.json'),
+        _CHAT_PATHS={}, _CHAT_META={}, _CHAT_HEADERS={}, _PENDING_SAVES={},
+        _INDEX_LOADED=False, _INDEX_DIRTY=False,
+    )
+
 def cleanup_test_environment() -> None:
     """Clean up test environment resources."""
     pass
@@ -0,0 +1,260 @@
+"""
+Focused tests for FoundryCLI output handling.
+
+Authors:
+    - Benjamin Dourthe (benjamin@adonamed.com)
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import isolated_storage
+from core import foundry_cli, storage
+from core.foundry_cli import FoundryCLI
+from core.token_tracker import TokenTracker
+
+_OPEN = "<|start|>assistant<|channel|>final<|message|>"
+_END = "<|return|>"
+
+# Stand-in for the foundry CLI: `model run` reports ready, `chat` answers "burst N" with N
+# replies written in a single burst so they straddle the reader's 64 KiB reads
+_STUB = r'''
+import sys
+if sys.argv[1:3] == ["model", "run"]:
+    print("Model loaded successfully", flush=True)
+    sys.exit(0)
+if sys.argv[1:2] != ["chat"]:
+    sys.exit(0)
+print("Interactive mode, enter your prompt", flush=True)
+sent = 0
+for line in sys.stdin:
+    words = line.split()
+    if words[:1] == ["exit"]:
+        break
+    if words[:1] != ["burst"]:
+        continue
+    out = []
+    for _ in range(int(words[1])):
+        out.append("%sreply %d %s\n<|return|>\n" % ("<|start|>assistant<|channel|>final<|message|>", sent, "\u00e9" * 1500))
+        sent += 1
+    sys.stdout.buffer.write("".join(out).encode("utf-8"))
+    sys.stdout.flush()
+'''
+
+
+class AssistantTrackingTests(unittest.TestCase):
+    """Completed assistant blocks reach the callback and the token tracker."""
+
+    def setUp(self) -> None:
+        """Create a CLI with a private tracker and a recording callback."""
+        self.cli = FoundryCLI()
+        self.cli._token_tracker = TokenTracker()
+        self.replies = []
+        self.cli._on_assistant = self.replies.append
+        self.cli._flush_ns = 10**18  # Keep time-based flushes out of the way
+
+    def _send(self, chat_id: str, prompt: str) -> None:
+        """Register a request the way send_prompt does, without a child process."""
+        self.cli._current_chat_id = chat_id
+        self.cli._current_request_id = self.cli._token_tracker.start_request(chat_id, prompt)
+
+    def test_reply_completes_tracked_request(self) -> None:
+        """A reply records one metrics entry and is emitted once."""
+        self._send("chat-a", "hello there")
+        self.cli._process_line(_OPEN + "general kenobi")
+        self.cli._process_line("you are a bold one")
+        self.cli._process_line(_END)
+        metrics = self.cli._token_tracker.get_chat_metrics("chat-a")
+        self.assertEqual(len(metrics), 1)
+        self.assertGreater(metrics[0].output_tokens, 0)
+        self.assertEqual(self.cli._token_tracker.get_chat_total_tokens("chat-a"), metrics[0].total_tokens)
+        self.assertEqual(self.replies, ["general kenobi\nyou are a bold one"])
+
+    def test_consecutive_replies_are_not_repeated(self) -> None:
+        """Each prompt yields exactly its own reply, with one metrics entry per request."""
+        for i in range(3):
+            self._send("chat-b", f"prompt {i}")
+            self.cli._process_line(_OPEN + f"echo {i}" + _END)
+        self.assertEqual(self.replies, ["echo 0", "echo 1", "echo 2"])
+        self.assertEqual(len(self.cli._token_tracker.get_chat_metrics("chat-b")), 3)
+        self.assertEqual([m["content"] for m in self.cli._chat_sessions["chat-b"]], ["echo 0", "echo 1", "echo 2"])
+
+
+class SessionCacheTests(unittest.TestCase):
+    """Only histories storage can give back are evicted from memory."""
+
+    def setUp(self) -> None:
+        """Point storage at a temporary directory and shrink the session cap."""
+        self.tmp = tempfile.mkdtemp()
+        self.patches = [
+            isolated_storage(self.tmp),
+            mock.patch.object(foundry_cli, '_SESSION_CACHE_CHATS', 2),
+        ]
+        for p in self.patches:
+            p.start()
+        self.cli = FoundryCLI()
+
+    def tearDown(self) -> None:
+        """Restore storage and remove the temporary directory."""
+        for p in reversed(self.patches):
+            p.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_unsaved_history_is_kept(self) -> None:
+        """A chat whose messages exist only in memory survives going over the cap."""
+        self.cli._session("unsaved").append({"role": "user", "content": "only here"})
+        for chat_id in ("b", "c", "d"):
+            self.cli._session(chat_id)
+        self.assertIn("unsaved", self.cli._chat_sessions)
+        self.assertEqual(self.cli._session("unsaved"), [{"role": "user", "content": "only here"}])
+
+    def test_saved_history_is_evicted_and_reloaded(self) -> None:
+        """A chat storage holds is dropped past the cap and comes back from storage."""
+        chat_id = storage.create_chat("Saved")
+        turns = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        storage.save_messages(chat_id, turns)
+        self.cli._session(chat_id).extend(turns)
+        for other in ("b", "c"):
+            self.cli._session(other)
+        self.assertNotIn(chat_id, self.cli._chat_sessions)
+        self.assertEqual(self.cli._session(chat_id), turns)
+
+    def test_reply_for_evicted_chat_does_not_load(self) -> None:
+        """The reader-thread append skips an evicted chat instead of reading storage."""
+        self.cli._evicted_sessions.add("gone")
+        with mock.patch.object(storage, 'load_chat') as load_chat:
+            self.cli._append_turn("gone", {"role": "assistant", "content": "late"})
+        load_chat.assert_not_called()
+        self.assertNotIn("gone", self.cli._chat_sessions)
+
+
+class CleanupGateTests(unittest.TestCase):
+    """No foundry process is spawned while unload_model's sweep is still running."""
+
+    def setUp(self) -> None:
+        """Leave a sweep thread running and record every spawn attempt."""
+        self.release = threading.Event()
+        self.cli = FoundryCLI()
+        self.cli._cleanup_thread = threading.Thread(target=self.release.wait, daemon=True)
+        self.cli._cleanup_thread.start()
+        self.spawned = []
+        run = lambda cmd, *a, **k: self.spawned.append(cmd) or types.SimpleNamespace(stdout=b"", returncode=0)
+        self.patches = [
+            mock.patch.object(foundry_cli, '_CLEANUP_WAIT', 0.05),
+            mock.patch.object(foundry_cli.subprocess, 'run', side_effect=run),
+            mock.patch.object(foundry_cli.subprocess, 'Popen', side_effect=lambda cmd, *a, **k: self.spawned.append(cmd)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self) -> None:
+        """Let the sweep thread finish and restore subprocess."""
+        self.release.set()
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_commands_wait_for_running_sweep(self) -> None:
+        """Listing, downloading, removing and starting a chat all refuse to spawn."""
+        self.assertEqual(self.cli.list_models(), [])
+        self.assertEqual(self.cli.list_cached_pairs(), [])
+        self.assertFalse(self.cli.ensure_model_downloaded("m"))
+        self.assertFalse(self.cli.remove_cached_model("m"))
+        self.assertFalse(self.cli.remove_cached_model_stream("m"))
+        with self.assertRaises(RuntimeError):
+            self.cli.start_chat("m")
+        self.assertEqual(self.spawned, [])
+
+    def test_commands_run_once_sweep_ends(self) -> None:
+        """After the sweep finishes, commands spawn again."""
+        self.release.set()
+        self.cli._cleanup_thread.join()
+        self.cli.list_models()
+        self.assertEqual(self.spawned, [["foundry", "model", "list"]])
+
+
+@unittest.skipIf(os.name == 'nt', "stub CLI is a POSIX shell script")
+class ReaderTests(unittest.TestCase):
+    """The reader delivers every streamed block exactly once."""
+
+    def setUp(self) -> None:
+        """Put a stub `foundry` first on PATH and start a chat against it."""
+        self.tmp = tempfile.mkdtemp()
+        stub = os.path.join(self.tmp, 'stub_cli.py')
+        with open(stub, 'w', encoding='utf-8') as f:
+            f.write(_STUB)
+        exe = os.path.join(self.tmp, 'foundry')
+        with open(exe, 'w', encoding='utf-8') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{stub}" "$@"\n')
+        os.chmod(exe, 0o755)
+        self.cli = FoundryCLI()
+        self.cli._token_tracker = TokenTracker()
+        self.replies = []
+        self.got = threading.Condition()
+        self.patches = [
+            mock.patch.dict(os.environ, {'PATH': self.tmp + os.pathsep + os.environ.get('PATH', '')}),
+            # The orphan sweep kills every process named foundry; keep it away from the test run
+            mock.patch.object(self.cli, '_kill_orphaned_processes'),
+        ]
+        for p in self.patches:
+            p.start()
+        self.cli.start_chat("stub-model", on_assistant=self._on_reply, flush_secs=60)
+
+    def tearDown(self) -> None:
+        """Stop the chat and remove the stub."""
+        self.cli.stop_chat()
+        self.cli._wait_for_cleanup()
+        for p in reversed(self.patches):
+            p.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _on_reply(self, text: str) -> None:
+        """Record a reply and wake the waiting test."""
+        with self.got:
+            self.replies.append(text)
+            self.got.notify_all()
+
+    def _wait_for(self, count: int) -> None:
+        """Wait until at least count replies arrived, then a little longer for stray duplicates."""
+        with self.got:
+            self.got.wait_for(lambda: len(self.replies) >= count, timeout=20)
+        time.sleep(0.2)
+
+    def test_bursts_arrive_once_in_order(self) -> None:
+        """Replies split across 64 KiB reads and UTF-8 boundaries are neither lost nor repeated."""
+        self.cli.send_prompt("burst 40", "chat-r")
+        self.cli.send_prompt("burst 5", "chat-r")
+        self._wait_for(45)
+        expected = ["reply %d %s" % (i, "\u00e9" * 1500) for i in range(45)]
+        self.assertEqual(self.replies, expected)
+
+    def test_each_prompt_tracked_once(self) -> None:
+        """Sequential prompts each complete their tracked request."""
+        for _ in range(3):
+            self.cli.send_prompt("burst 1", "chat-t")
+            self._wait_for(len(self.replies) + 1)
+        self.assertEqual(len(self.replies), 3)
+        self.assertEqual(len(self.cli._token_tracker.get_chat_metrics("chat-t")), 3)
+
+    def test_unload_closes_wake_pipe(self) -> None:
+        """unload_model releases both ends of the reader's wake pipe."""
+        self.cli.send_prompt("burst 1", "chat-u")
+        self._wait_for(1)
+        fds = self.cli._wake_fds
+        self.assertIsNotNone(fds)
+        self.cli.unload_model()
+        self.cli._wait_for_cleanup()
+        self.assertIsNone(self.cli._wake_fds)
+        for fd in fds:
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Focused tests for chat storage: debounced saves and the sidecar chat index.
+
+Authors:
+    - Benjamin Dourthe (benjamin@adonamed.com)
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+_SRC = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+sys.path.insert(0, _SRC)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from core import storage
+from common import isolated_storage
+
+
+class StorageTestCase(unittest.TestCase):
+    """Run each test against an empty storage tree in a temporary directory."""
+
+    def setUp(self) -> None:
+        """Point storage at a temporary directory with empty caches."""
+        self.tmp = tempfile.mkdtemp()
+        self.patch = isolated_storage(self.tmp)
+        self.patch.start()
+
+    def tearDown(self) -> None:
+        """Drop pending saves, restore storage and remove the directory."""
+        for _, timer in list(storage._PENDING_SAVES.values()):
+            timer.cancel()
+        self.patch.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _forget(self) -> None:
+        """Clear in-memory caches, as a fresh process would start."""
+        storage._CHAT_PATHS.clear()
+        storage._CHAT_META.clear()
+        storage._CHAT_HEADERS.clear()
+        storage._INDEX_LOADED = False
+        storage._INDEX_DIRTY = False
+
+
+class DebouncedSaveTests(StorageTestCase):
+    """Saves are coalesced but never lost."""
+
+    def test_load_flushes_pending_save(self) -> None:
+        """A load right after save_messages sees the latest messages, not the file on disk."""
+        chat_id = storage.create_chat("Debounce")
+        storage.save_messages(chat_id, [{'role': 'user', 'content': 'first'}])
+        storage.save_messages(chat_id, [{'role': 'user', 'content': 'first'}, {'role': 'assistant', 'content': 'second'}])
+        self.assertIn(chat_id, storage._PENDING_SAVES)
+        data = storage.load_chat(chat_id)
+        self.assertEqual([m['content'] for m in data['messages']], ['first', 'second'])
+        self.assertNotIn(chat_id, storage._PENDING_SAVES)
+
+    def test_timer_writes_after_delay(self) -> None:
+        """Without any read, the debounce timer writes the file by itself."""
+        chat_id = storage.create_chat("Timer")
+        storage.save_messages(chat_id, [{'role': 'user', 'content': 'later'}])
+        time.sleep(storage._SAVE_DELAY + 0.5)
+        self.assertEqual(storage._PENDING_SAVES, {})
+        path = storage._CHAT_PATHS[chat_id]
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['messages'][0]['content'], 'later')
+
+    def test_sync_save_writes_durably_now(self) -> None:
+        """save_messages(sync=True) replaces a pending save and fsyncs the file before returning."""
+        chat_id = storage.create_chat("Sync")
+        storage.save_messages(chat_id, [{'role': 'user', 'content': 'stale'}])
+        with mock.patch.object(storage.os, 'fsync', wraps=os.fsync) as fsync:
+            storage.save_messages(chat_id, [{'role': 'user', 'content': 'now'}], sync=True)
+        self.assertEqual(fsync.call_count, 1)
+        self.assertEqual(storage._PENDING_SAVES, {})
+        with open(storage._chat_path(chat_id), encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['messages'], [{'role': 'user', 'content': 'now'}])
+
+    def test_exit_flushes_pending_save(self) -> None:
+        """A process exiting inside the debounce window still writes its last save."""
+        script = (
+            "import sys; sys.path.insert(0, sys.argv[1]); from core import storage; "
+            "cid = storage.create_chat('Exit'); "
+            "storage.save_messages(cid, [{'role': 'user', 'content': 'bye'}]); print(cid)"
+        )
+        env = dict(os.environ, HOME=self.tmp, USERPROFILE=self.tmp, LOCALAPPDATA=self.tmp)
+        out = subprocess.run([sys.executable, "-c", script, _SRC], env=env, capture_output=True, text=True, timeout=60)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        chats_dir = os.path.join(self.tmp, '.local-ai-chat', 'chat_history')
+        (name,) = [n for n in os.listdir(chats_dir) if n.endswith('.json')]
+        with open(os.path.join(chats_dir, name), encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertEqual(data['id'], out.stdout.strip())
+        self.assertEqual(data['messages'], [{'role': 'user', 'content': 'bye'}])
+        # The index written at exit already knows the chat
+        with open(os.path.join(self.tmp, '.local-ai-chat', 'chat_index.json'), encoding='utf-8') as f:
+            self.assertIn(name, json.load(f)['chats'])
+
+    def test_save_timer_waits_for_rename(self) -> None:
+        """A debounced save firing mid-rename lands in the renamed file instead of the old one."""
+        chat_id = storage.create_chat("Racing")
+        write_json = storage._write_json
+        written = threading.Event()
+
+        def racing_write(*args, **kwargs):
+            # The rename's own write starts a save whose timer fires at once
+            if threading.current_thread() is threading.main_thread() and not written.is_set():
+                written.set()
+                storage.save_messages(chat_id, [{'role': 'user', 'content': 'racing'}])
+                time.sleep(0.3)
+            return write_json(*args, **kwargs)
+
+        with mock.patch.object(storage, '_SAVE_DELAY', 0), mock.patch.object(storage, '_write_json', racing_write):
+            storage.rename_chat(chat_id, "Renamed")
+            storage.flush_pending_writes()
+        time.sleep(0.3)  # Let the timer thread return before the directory is checked
+        names = [n for n in os.listdir(storage._CHATS_DIR) if n.endswith('.json')]
+        self.assertEqual(len(names), 1)
+        self._forget()
+        data = storage.load_chat(chat_id)
+        self.assertEqual(data['title'], "Renamed")
+        self.assertEqual(data['messages'], [{'role': 'user', 'content': 'racing'}])
+
+
+class ChatIndexTests(StorageTestCase):
+    """The sidecar index is trusted only while a chat file is unchanged."""
+
+    def _edit_title(self, chat_id: str, title: str) -> None:
+        """Rewrite a chat's title behind storage's back, as another program would."""
+        path = storage._chat_path(chat_id)
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        data['title'] = title
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    def test_index_persists_metadata(self) -> None:
+        """list_chats writes the index, and a fresh process lists from it without parsing."""
+        chat_id = storage.create_chat("Indexed")
+        storage.list_chats()
+        self.assertTrue(os.path.exists(storage._INDEX_FILE))
+        self._forget()
+        with mock.patch.object(storage, '_read_json', wraps=storage._read_json) as read_json:
+            chats = storage.list_chats()
+        self.assertEqual([(c['id'], c['title']) for c in chats], [(chat_id, "Indexed")])
+        # Only the index itself is read
+        self.assertEqual([call.args[0] for call in read_json.call_args_list], [storage._INDEX_FILE])
+
+    def test_external_edit_invalidates_entry(self) -> None:
+        """A file changed outside the app is re-read, in this process and in a fresh one."""
+        chat_id = storage.create_chat("Before")
+        storage.list_chats()
+        self._edit_title(chat_id, "Edited elsewhere")
+        self.assertEqual(storage.list_chats()[0]['title'], "Edited elsewhere")
+        storage.list_chats()
+        self._forget()
+        self._edit_title(chat_id, "Edited again")
+        self._forget()
+        self.assertEqual(storage.list_chats()[0]['title'], "Edited again")
+
+    def test_deleted_file_leaves_index(self) -> None:
+        """Chats removed on disk or via delete_chat drop out of the listing and the index."""
+        kept = storage.create_chat("Kept")
+        gone = storage.create_chat("Gone")
+        removed = storage.create_chat("Removed")
+        storage.list_chats()
+        os.remove(storage._CHAT_PATHS[gone])
+        storage.delete_chat(removed)
+        self.assertEqual([c['id'] for c in storage.list_chats()], [kept])
+        with open(storage._INDEX_FILE, encoding='utf-8') as f:
+            entries = json.load(f)['chats']
+        self.assertEqual([e[2] for e in entries.values()], [kept])
+
+
+if __name__ == '__main__':
+    unittest.main()